@@ -140,6 +140,16 @@ def restart_command(call: types.CallbackQuery):
     )
 
 
+@bot.callback_query_handler(cb_query_equals('apply_config'), is_admin=True)
+def apply_config_command(call: types.CallbackQuery):
+    bot.edit_message_text(
+        '⚠️ Применить изменения? Xray core будет перезапущен, только если их нельзя применить без перезапуска.',
+        call.message.chat.id,
+        call.message.message_id,
+        reply_markup=BotKeyboard.confirm_action(action='apply_config')
+    )
+
+
 @bot.callback_query_handler(cb_query_startswith('delete:'), is_admin=True)
 def delete_user_command(call: types.CallbackQuery):
     username = call.data.split(':')[1]
@@ -1592,9 +1602,10 @@ def confirm_user_command(call: types.CallbackQuery):
         m = bot.edit_message_text(
             '🔄 Перезапуск XRay core...', call.message.chat.id, call.message.message_id)
         config = xray.config.include_db_users()
-        xray.core.restart(config)
+        xray.core.schedule_restart(config).result()
         for node_id, node in list(xray.nodes.items()):
             if node.connected:
+                xray.core.remember_node_config(node_id, config)
                 xray.operations.restart_node(node_id, config)
         bot.edit_message_text(
             '✅ XRay core успешно перезапущен.',
@@ -1602,6 +1613,23 @@ def confirm_user_command(call: types.CallbackQuery):
             reply_markup=BotKeyboard.main_menu()
         )
 
+    elif data == 'apply_config':
+        m = bot.edit_message_text(
+            '🔄 Применение изменений XRay core...', call.message.chat.id, call.message.message_id)
+        config = xray.config.include_db_users()
+        # clients changes are applied through the API, other changes restart xray
+        xray.core.schedule_restart(config, api=xray.api).result()
+        for node_id, node in list(xray.nodes.items()):
+            if not node.connected:
+                xray.core.forget_node_config(node_id)
+            elif xray.core.node_config_changed(node_id, config):
+                xray.operations.restart_node(node_id, config)
+        bot.edit_message_text(
+            '✅ Изменения XRay core успешно применены.',
+            m.chat.id, m.message_id,
+            reply_markup=BotKeyboard.main_menu()
+        )
+
     elif data in ['charge_add', 'charge_reset']:
         _, _, username, template_id = call.data.split(":")
         with GetDB() as db:
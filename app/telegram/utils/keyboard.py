@@ -22,6 +22,8 @@ class BotKeyboard:
         keyboard.add(
             types.InlineKeyboardButton(text='🔁 Инфо о системе', callback_data='system'),
             types.InlineKeyboardButton(text='♻️ Перезапуск Xray', callback_data='restart'))
+        keyboard.add(
+            types.InlineKeyboardButton(text='🔃 Применить изменения', callback_data='apply_config'))
         keyboard.add(
             types.InlineKeyboardButton(text='👥 Пользователи', callback_data='users:1'),
             types.InlineKeyboardButton(text='✏️ Редактировать всех', callback_data='edit_all'))
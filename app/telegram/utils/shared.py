@@ -3,6 +3,7 @@ from datetime import datetime as dt
 
 from dateutil.relativedelta import relativedelta
 
+from app import xray
 from app.models.user import User, UserResponse, UserStatus
 from app.models.user_template import UserTemplate
 from app.utils.system import readable_size
@@ -65,6 +66,8 @@ def get_user_info_text(db_user: User) -> str:
     expiry_date = dt.fromtimestamp(user.expire).date() if user.expire else "Никогда"
     time_left = time_to_string(dt.fromtimestamp(user.expire)) if user.expire else "-"
     online_at = time_to_string(user.online_at) if user.online_at else "-"
+    if xray.core.presence.running and xray.core.presence.is_online(db_user.id):
+        online_at = f"сейчас (IP: <code>{xray.core.presence.ip_count(db_user.id)}</code>)"
     sub_updated_at = time_to_string(user.sub_updated_at) if user.sub_updated_at else "-"
     if user.status == UserStatus.on_hold:
         expiry_text = f"⏰ <b>Длительность ожидания:</b> <code>{on_hold_duration} дней</code> (автозапуск <code>{
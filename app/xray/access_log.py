@@ -0,0 +1,138 @@
+import os
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import List, NamedTuple, Optional
+
+XRAY_ACCESS_LOG_INDEX = os.environ.get("XRAY_ACCESS_LOG_INDEX", "false").lower() == "true"
+XRAY_ACCESS_LOG_PER_USER = int(os.environ.get("XRAY_ACCESS_LOG_PER_USER", 100))
+XRAY_ACCESS_LOG_MAX_USERS = int(os.environ.get("XRAY_ACCESS_LOG_MAX_USERS", 100000))
+
+# 2026/10/18 14:02:11.123456 from tcp:1.2.3.4:50000 accepted tcp:example.com:443 [VLESS_TCP >> DIRECT] email: 5.user
+# 2026/10/18 14:02:11 from 1.2.3.4:50000 rejected  proxy/vless/encoding: invalid request user id
+ACCESS_LINE = re.compile(
+    r'(?P<date>\d{4}/\d\d/\d\d \d\d:\d\d:\d\d)(?P<fraction>\.\d+)? '
+    r'from (?:tcp:|udp:)?(?P<source>\[[^\]]+\]|[^\s:]+):\d+ '
+    r'(?:(?P<accepted>accepted)|rejected) +'
+    r'(?:(?P<destination>(?:tcp|udp):\S+)'
+    r'(?: \[(?P<inbound>[^\]\s]+)(?: (?:>>|->) [^\]]*)?\])?)?'
+    r'.*?(?: email: (?P<email>\S+))?$'
+)
+
+
+class AccessRecord(NamedTuple):
+    ts: float
+    source: str
+    destination: Optional[str]
+    inbound: Optional[str]
+    email: Optional[str]
+    accepted: bool
+
+
+class _TimestampParser:
+    # access lines come in time order, so most of them share the second of
+    # the previous one and strptime only runs once per second
+    def __init__(self):
+        self._date = None
+        self._seconds = None
+
+    def __call__(self, date: str, fraction: Optional[str]) -> float:
+        if date != self._date:
+            self._seconds = time.mktime(time.strptime(date, "%Y/%m/%d %H:%M:%S"))
+            self._date = date
+        return self._seconds + float(fraction) if fraction else self._seconds
+
+
+def parse_line(line: str, parse_timestamp: callable = None) -> Optional[AccessRecord]:
+    """AccessRecord of an access log line, None for any other line."""
+    if ' from ' not in line:
+        return None
+    m = ACCESS_LINE.match(line)
+    if m is None:
+        return None
+    if parse_timestamp is None:
+        parse_timestamp = _TimestampParser()
+    source = m.group('source')
+    if source[0] == '[':
+        source = source[1:-1]
+    return AccessRecord(
+        parse_timestamp(m.group('date'), m.group('fraction')),
+        source,
+        m.group('destination'),
+        m.group('inbound'),
+        m.group('email'),
+        m.group('accepted') is not None
+    )
+
+
+class AccessLogIndex:
+    """
+    Parses access lines out of the captured Xray output (as a log sink of
+    XRayCore) and keeps the last per_user records of each user in a ring,
+    users are evicted least recently active first beyond max_users.
+    """
+
+    def __init__(self, per_user: int = XRAY_ACCESS_LOG_PER_USER, max_users: int = XRAY_ACCESS_LOG_MAX_USERS):
+        self.per_user = per_user
+        self.max_users = max_users
+        self._lock = threading.Lock()
+        self._users = OrderedDict()  # email -> deque of AccessRecord
+        self._parse_timestamp = _TimestampParser()
+
+        self.lines = 0
+        self.records = 0
+        self.rejected = 0
+        self.evicted_users = 0
+        self.parse_time = 0.0
+
+    def feed(self, lines: List[str]):
+        started_at = time.perf_counter()
+        records = []
+        for line in lines:
+            record = parse_line(line, self._parse_timestamp)
+            if record is not None:
+                records.append(record)
+
+        with self._lock:
+            users = self._users
+            for record in records:
+                if not record.accepted:
+                    self.rejected += 1
+                if record.email is None:
+                    continue
+                ring = users.get(record.email)
+                if ring is None:
+                    ring = users[record.email] = deque(maxlen=self.per_user)
+                    if len(users) > self.max_users:
+                        users.popitem(last=False)
+                        self.evicted_users += 1
+                else:
+                    users.move_to_end(record.email)
+                ring.append(record)
+
+        self.lines += len(lines)
+        self.records += len(records)
+        self.parse_time += time.perf_counter() - started_at
+
+    def recent(self, email: str, seconds: float = None) -> List[AccessRecord]:
+        """Records of a user (email is "<user id>.<username>"), oldest first."""
+        with self._lock:
+            ring = self._users.get(email)
+            records = list(ring) if ring else []
+        if seconds is not None:
+            since = time.time() - seconds
+            records = [record for record in records if record.ts >= since]
+        return records
+
+    def stats(self) -> dict:
+        with self._lock:
+            users = len(self._users)
+        return {
+            "lines": self.lines,
+            "records": self.records,
+            "rejected": self.rejected,
+            "users": users,
+            "evicted_users": self.evicted_users,
+            "lines_per_second": self.lines / self.parse_time if self.parse_time else None
+        }
@@ -0,0 +1,128 @@
+import json
+import os
+import re
+import subprocess
+import threading
+
+from app import logger
+
+XRAY_METADATA_CACHE = os.environ.get("XRAY_METADATA_CACHE", "/var/lib/marzban/.xray-metadata.json")
+
+
+def _run(executable_path: str, *args) -> str:
+    return subprocess.check_output(
+        [executable_path, *args], stdin=subprocess.DEVNULL, stderr=subprocess.STDOUT, timeout=30
+    ).decode('utf-8')
+
+
+def probe_version(executable_path: str) -> str:
+    try:
+        m = re.search(r'Xray (\d+\.\d+\.\d+)', _run(executable_path, "version"))
+        if m:
+            return m.group(1)
+        return "unknown"
+    except Exception as e:
+        logger.error(f"Error getting Xray version: {e}")
+        return "error"
+
+
+def probe_commands(executable_path: str) -> list:
+    """Names of the subcommands listed by `xray help`, e.g. run, x25519, uuid."""
+    try:
+        output = _run(executable_path, "help")
+    except subprocess.CalledProcessError as e:
+        output = e.output.decode('utf-8', 'replace')
+    except Exception as e:
+        logger.error(f"Error probing Xray commands: {e}")
+        return []
+    return sorted(set(re.findall(r'^\s+([a-z][\w-]*)\s{2,}\S', output, re.MULTILINE)))
+
+
+class XRayBinaryInfo:
+    """
+    Version and capabilities of an Xray executable. Results are cached on disk,
+    keyed by the executable's path, inode, size and mtime, so the binary is
+    only probed again after it has been replaced. Probing runs in background.
+    """
+
+    def __init__(self, executable_path: str, cache_path: str = XRAY_METADATA_CACHE):
+        self.executable_path = executable_path
+        self.cache_path = cache_path
+        self._metadata = None
+        self._probed = threading.Event()
+        self._thread = None
+
+    def identity(self) -> list:
+        path = os.path.realpath(self.executable_path)
+        stat = os.stat(path)
+        return [path, stat.st_ino, stat.st_size, stat.st_mtime_ns]
+
+    def _load_cache(self, identity: list):
+        try:
+            with open(self.cache_path) as file:
+                cache = json.load(file)
+        except (OSError, ValueError):
+            return None
+
+        if cache.get("identity") == identity:
+            return cache
+
+    def _save_cache(self, metadata: dict):
+        try:
+            tmp_path = f"{self.cache_path}.tmp"
+            with open(tmp_path, 'w') as file:
+                json.dump(metadata, file)
+            os.replace(tmp_path, self.cache_path)
+        except OSError as e:
+            logger.debug(f"Unable to save Xray metadata cache: {e}")
+
+    def _probe(self, identity: list):
+        try:
+            metadata = {
+                "identity": identity,
+                "version": probe_version(self.executable_path),
+                "commands": probe_commands(self.executable_path)
+            }
+            self._metadata = metadata
+            if metadata["version"] != "error":
+                self._save_cache(metadata)
+        finally:
+            self._probed.set()
+
+    def load(self):
+        """Loads cached metadata or starts probing the binary in background."""
+        try:
+            identity = self.identity()
+        except OSError as e:
+            logger.error(f"Error getting Xray version: {e}")
+            self._metadata = {"identity": None, "version": "error", "commands": []}
+            self._probed.set()
+            return
+
+        cached = self._load_cache(identity)
+        if cached:
+            self._metadata = cached
+            self._probed.set()
+            return
+
+        self._probed.clear()
+        self._thread = threading.Thread(target=self._probe, args=(identity,), daemon=True)
+        self._thread.start()
+
+    def wait(self, timeout: float = None) -> bool:
+        return self._probed.wait(timeout)
+
+    @property
+    def version(self) -> str:
+        if self._metadata is None:
+            return "unknown"
+        return self._metadata["version"]
+
+    @property
+    def commands(self) -> list:
+        if self._metadata is None:
+            return []
+        return self._metadata["commands"]
+
+    def supports(self, command: str) -> bool:
+        return command in self.commands
@@ -1,22 +1,44 @@
 from __future__ import annotations
 
+import hashlib
 import json
+import os
+import threading
+import time
+import weakref
 from app import logger
-from collections import defaultdict
+from contextlib import nullcontext
 from copy import deepcopy
+from functools import lru_cache
+from itertools import chain
 from pathlib import PosixPath
-from typing import Union
+from typing import NamedTuple, Union
 
 import commentjson
-from sqlalchemy import func
+from sqlalchemy import event, func, inspect
+from sqlalchemy.orm import Session
 
 from app.db import GetDB
 from app.db import models as db_models
 from app.models.proxy import ProxyTypes
 from app.models.user import UserStatus
 from app.utils.crypto import get_cert_SANs
+from app.xray import serializer
+from app.xray.presence import XRAY_PRESENCE_TRACKER
 from config import DEBUG, XRAY_EXCLUDE_INBOUND_TAGS, XRAY_FALLBACKS_INBOUND_TAG
 
+XRAY_INCREMENTAL_CLIENTS = os.environ.get("XRAY_INCREMENTAL_CLIENTS", "false").lower() == "true"
+# changes are tracked through this process' sessions only, writes of other processes
+# (CLI, other workers) are picked up by a full rebuild of the index every that many seconds
+XRAY_INCREMENTAL_CLIENTS_REBUILD = float(os.environ.get("XRAY_INCREMENTAL_CLIENTS_REBUILD", 3600))
+
+USERS_QUERY_CHUNK_SIZE = 1000
+# changed users are queried by id in chunks, drivers limit the number of bind parameters (999 on older SQLite)
+CHANGED_USERS_CHUNK_SIZE = 500
+
+# columns of users table which change the generated clients
+_CLIENT_USER_COLUMNS = ('id', 'username', 'status')
+
 
 def merge_dicts(a, b):  # B will override A dictionary key and values
     for key, value in b.items():
@@ -27,29 +49,278 @@ def merge_dicts(a, b):  # B will override A dictionary key and values
     return a
 
 
+@lru_cache(maxsize=8)
+def _normalize_config_text(text: str) -> str:
+    try:
+        # the C parser is much faster and most configs have no comments
+        json.loads(text)
+        return text
+    except json.JSONDecodeError:
+        return json.dumps(commentjson.loads(text))
+
+
+def parse_config_text(text: str) -> dict:
+    # only the comment-free text is cached, every call gets its own dicts,
+    # so editing a parsed config can't affect later parses
+    return json.loads(_normalize_config_text(text))
+
+
+_config_files_cache = {}
+
+
+def load_config_file(path: Union[str, PosixPath]) -> dict:
+    path = os.fspath(path)
+    stat = os.stat(path)
+    key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    try:
+        cached_key, text = _config_files_cache[path]
+        if cached_key == key:
+            return json.loads(text)
+    except KeyError:
+        pass
+
+    with open(path, 'r') as file:
+        text = _normalize_config_text(file.read())
+    _config_files_cache[path] = (key, text)
+    return json.loads(text)
+
+
+def copy_mutable_sections(config: dict) -> dict:
+    """
+    Copies only the parts of a config which are mutated while building or
+    pushing it: inbounds with their settings, clients and streamSettings
+    (nodes inline the TLS certificate files in place), the routing rules
+    list, api, log, policy and stats.
+
+    Everything else is shared with the source, that is outbounds, routing
+    rules and balancers themselves, dns and any other top-level section.
+    Callers must not mutate those in place, replace them instead.
+    """
+    copied = dict(config)
+
+    if 'inbounds' in config:
+        inbounds = []
+        for inbound in config['inbounds']:
+            inbound = dict(inbound)
+            if isinstance(inbound.get('settings'), dict):
+                inbound['settings'] = settings = dict(inbound['settings'])
+                if isinstance(settings.get('clients'), list):
+                    settings['clients'] = list(settings['clients'])
+            if isinstance(inbound.get('streamSettings'), dict):
+                inbound['streamSettings'] = deepcopy(inbound['streamSettings'])
+            inbounds.append(inbound)
+        copied['inbounds'] = inbounds
+
+    if isinstance(config.get('routing'), dict):
+        copied['routing'] = routing = dict(config['routing'])
+        if isinstance(routing.get('rules'), list):
+            routing['rules'] = list(routing['rules'])
+
+    for key in ('api', 'log', 'policy', 'stats'):
+        if key in config:
+            copied[key] = deepcopy(config[key])
+
+    return copied
+
+
+def _without_clients(inbound: dict) -> dict:
+    if 'clients' not in inbound.get('settings', {}):
+        return inbound
+    settings = dict(inbound['settings'])
+    del settings['clients']
+    return {**inbound, 'settings': settings}
+
+
+def diff_inbound_clients(old: dict, new: dict):
+    """
+    Returns {inbound_tag: (added_clients, removed_emails)} if the configs differ
+    in inbounds' clients only, otherwise None. A modified client is both removed and added.
+    """
+    if old.keys() != new.keys():
+        return None
+    for key in old:
+        if key != 'inbounds' and old[key] != new[key]:
+            return None
+
+    old_inbounds, new_inbounds = old.get('inbounds', []), new.get('inbounds', [])
+    if len(old_inbounds) != len(new_inbounds):
+        return None
+
+    changes = {}
+    for old_inbound, new_inbound in zip(old_inbounds, new_inbounds):
+        if _without_clients(old_inbound) != _without_clients(new_inbound):
+            return None
+
+        old_clients = {c.get('email'): c for c in old_inbound.get('settings', {}).get('clients', [])}
+        new_clients = {c.get('email'): c for c in new_inbound.get('settings', {}).get('clients', [])}
+        if old_clients == new_clients:
+            continue
+
+        added = [c for email, c in new_clients.items() if old_clients.get(email) != c]
+        removed = [email for email, c in old_clients.items() if new_clients.get(email) != c]
+        changes[new_inbound['tag']] = (added, removed)
+
+    return changes
+
+
+class CertSANsCache:
+    """
+    Process-wide cache of certificates SANs, files are keyed by their
+    path, inode, mtime and size, inline certificates by their digest.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._files = {}
+        self._digests = {}
+        self.hits = 0
+        self.misses = 0
+
+    def from_file(self, path: str) -> tuple:
+        stat = os.stat(path)
+        key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+        with self._lock:
+            cached = self._files.get(path)
+            if cached and cached[0] == key:
+                self.hits += 1
+                return cached[1]
+
+        with open(path, 'rb') as file:
+            sans = self.from_bytes(file.read())
+
+        with self._lock:
+            self._files[path] = (key, sans)
+        return sans
+
+    def from_bytes(self, cert: bytes) -> tuple:
+        digest = hashlib.sha256(cert).digest()
+
+        with self._lock:
+            if digest in self._digests:
+                self.hits += 1
+                return self._digests[digest]
+            self.misses += 1
+
+        sans = tuple(get_cert_SANs(cert))
+        with self._lock:
+            self._digests[digest] = sans
+        return sans
+
+    def clear(self):
+        with self._lock:
+            self._files.clear()
+            self._digests.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "files": len(self._files),
+                "certificates": len(self._digests)
+            }
+
+
+cert_SANs_cache = CertSANsCache()
+
+
+class CompiledInbound(NamedTuple):
+    """Per-inbound decisions needed when building clients, resolved once."""
+    tag: str
+    allows_flow: bool
+
+
+class UserChangeTracker:
+    """
+    Watches ORM sessions and tells subscribed configs which users' clients
+    have to be rebuilt. Changes are published only after the session commits.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._configs = weakref.WeakSet()
+        self._registered = False
+
+    def subscribe(self, config: XRayConfig):
+        with self._lock:
+            if not self._registered:
+                event.listen(Session, 'after_flush', self._after_flush)
+                event.listen(Session, 'after_commit', self._after_commit)
+                event.listen(Session, 'after_rollback', self._after_rollback)
+                event.listen(Session, 'do_orm_execute', self._do_orm_execute)
+                self._registered = True
+            self._configs.add(config)
+
+    @staticmethod
+    def _affects_clients(user) -> bool:
+        state = inspect(user)
+        return any(state.attrs[key].history.has_changes() for key in _CLIENT_USER_COLUMNS)
+
+    def _after_flush(self, session, flush_context):
+        changed = session.info.setdefault('xray_changed_user_ids', set())
+        for obj in chain(session.new, session.dirty, session.deleted):
+            if isinstance(obj, db_models.User):
+                if obj in session.new or obj in session.deleted or self._affects_clients(obj):
+                    changed.add(obj.id)
+            elif isinstance(obj, db_models.Proxy):
+                changed.add(obj.user_id)
+
+    def _do_orm_execute(self, orm_execute_state):
+        if not (orm_execute_state.is_update or orm_execute_state.is_delete):
+            return
+        classes = {mapper.class_ for mapper in orm_execute_state.all_mappers}
+        if db_models.Proxy in classes:
+            orm_execute_state.session.info['xray_clients_invalidated'] = True
+        elif db_models.User in classes:
+            values = getattr(orm_execute_state.statement, '_values', None)
+            keys = {getattr(column, 'key', column) for column in values} if values else None
+            # bulk counters updates (used_traffic, online_at, ...) don't change clients
+            if orm_execute_state.is_delete or keys is None or keys.intersection(_CLIENT_USER_COLUMNS):
+                orm_execute_state.session.info['xray_clients_invalidated'] = True
+
+    def _after_commit(self, session):
+        changed = session.info.pop('xray_changed_user_ids', None)
+        invalidated = session.info.pop('xray_clients_invalidated', False)
+        if not (changed or invalidated):
+            return
+        for config in list(self._configs):
+            if invalidated:
+                config.invalidate_clients()
+            else:
+                config.mark_users_changed(changed)
+
+    def _after_rollback(self, session):
+        session.info.pop('xray_changed_user_ids', None)
+        session.info.pop('xray_clients_invalidated', None)
+
+
+user_change_tracker = UserChangeTracker()
+
+
 class XRayConfig(dict):
     def __init__(self,
                  config: Union[dict, str, PosixPath] = {},
                  api_host: str = "127.0.0.1",
                  api_port: int = 8080):
         if isinstance(config, str):
-            try:
+            if '{' in config:
                 # considering string as json
-                config = commentjson.loads(config)
-            except (json.JSONDecodeError, ValueError):
+                config = parse_config_text(config)
+            else:
                 # considering string as file path
-                with open(config, 'r') as file:
-                    config = commentjson.loads(file.read())
-
-        if isinstance(config, PosixPath):
-            with open(config, 'r') as file:
-                config = commentjson.loads(file.read())
-
-        if isinstance(config, dict):
-            config = deepcopy(config)
+                config = load_config_file(config)
+        elif isinstance(config, PosixPath):
+            config = load_config_file(config)
+        elif isinstance(config, dict):
+            # a dict given by the caller is shared with it
+            config = copy_mutable_sections(config)
 
         self.api_host = api_host
         self.api_port = api_port
+        self._tag_indexes = {}
+        self._fingerprint = None
 
         super().__init__(config)
         self._validate()
@@ -57,11 +328,14 @@ class XRayConfig(dict):
         self.inbounds = []
         self.inbounds_by_protocol = {}
         self.inbounds_by_tag = {}
+        self._compiled_inbounds_by_protocol = {}
         self._fallbacks_inbound = self.get_inbound(XRAY_FALLBACKS_INBOUND_TAG)
         self._resolve_inbounds()
 
         self._apply_api()
 
+        self._init_clients_index()
+
     def _apply_api(self):
         api_inbound = self.get_inbound("API_INBOUND")
         if api_inbound:
@@ -93,6 +367,8 @@ class XRayConfig(dict):
                 "statsOutboundUplink": True
             }
         }
+        if XRAY_PRESENCE_TRACKER:
+            forced_policies["levels"]["0"]["statsUserOnline"] = True
         if self.get("policy"):
             self["policy"] = merge_dicts(self.get("policy"), forced_policies)
         else:
@@ -201,9 +477,7 @@ class XRayConfig(dict):
                     for certificate in tls_settings.get('certificates', []):
 
                         if certificate.get("certificateFile", None):
-                            with open(certificate['certificateFile'], 'rb') as file:
-                                cert = file.read()
-                                settings['sni'].extend(get_cert_SANs(cert))
+                            settings['sni'].extend(cert_SANs_cache.from_file(certificate['certificateFile']))
 
                         if certificate.get("certificate", None):
                             cert = certificate['certificate']
@@ -211,7 +485,7 @@ class XRayConfig(dict):
                                 cert = '\n'.join(cert)
                             if isinstance(cert, str):
                                 cert = cert.encode()
-                            settings['sni'].extend(get_cert_SANs(cert))
+                            settings['sni'].extend(cert_SANs_cache.from_bytes(cert))
 
                 elif security == 'reality':
                     settings['fp'] = 'chrome'
@@ -226,12 +500,18 @@ class XRayConfig(dict):
                             raise ValueError(
                                 f"You need to provide privateKey in realitySettings of {inbound['tag']}")
 
-                        try:
-                            from app.xray import core
-                            x25519 = core.get_x25519(pvk)
+                        from app.xray.core import x25519_keypair
+                        x25519 = x25519_keypair(pvk)
+
+                        if not x25519:
+                            try:
+                                from app.xray import core
+                                x25519 = core.get_x25519(pvk)
+                            except ImportError:
+                                pass
+
+                        if x25519:
                             settings['pbk'] = x25519['public_key']
-                        except ImportError:
-                            pass
 
                         if not settings.get('pbk'):
                             raise ValueError(
@@ -343,92 +623,210 @@ class XRayConfig(dict):
             except KeyError:
                 self.inbounds_by_protocol[inbound['protocol']] = [settings]
 
+            compiled = CompiledInbound(
+                tag=inbound['tag'],
+                # XTLS currently only supports transmission methods of TCP and mKCP
+                allows_flow=(
+                    settings['network'] in ('tcp', 'raw', 'kcp')
+                    and settings['tls'] in ('tls', 'reality')
+                    and settings['header_type'] != 'http'
+                )
+            )
+            try:
+                self._compiled_inbounds_by_protocol[inbound['protocol']].append(compiled)
+            except KeyError:
+                self._compiled_inbounds_by_protocol[inbound['protocol']] = [compiled]
+
+    def _get_tag_index(self, key: str) -> dict:
+        items = self[key]
+        try:
+            source, size, index = self._tag_indexes[key]
+            if source is items and size == len(items):
+                return index
+        except KeyError:
+            pass
+
+        # the list was replaced or items were inserted/removed since last lookup
+        index = {}
+        for item in items:
+            index.setdefault(item.get('tag'), item)
+        self._tag_indexes[key] = (items, len(items), index)
+        return index
+
+    @property
+    def api_address(self) -> tuple:
+        """(host, port) to connect to the API inbound, a wildcard listen address is reached on localhost."""
+        host = self.api_host
+        if host in ('0.0.0.0', '::', ''):
+            host = '127.0.0.1'
+        return host, self.api_port
+
     def get_inbound(self, tag) -> dict:
-        for inbound in self['inbounds']:
-            if inbound['tag'] == tag:
-                return inbound
+        return self._get_tag_index('inbounds').get(tag)
 
     def get_outbound(self, tag) -> dict:
-        for outbound in self['outbounds']:
-            if outbound['tag'] == tag:
-                return outbound
+        return self._get_tag_index('outbounds').get(tag)
 
     def to_json(self, **json_kwargs):
-        return json.dumps(self, **json_kwargs)
+        if json_kwargs:
+            return json.dumps(self, **json_kwargs)
+        return serializer.dumps(self)
+
+    def write_json(self, stream, sort_keys: bool = False, digest=None) -> int:
+        return serializer.dump(self, stream, sort_keys=sort_keys, digest=digest)
+
+    def fingerprint(self) -> str:
+        # computed once, a config mustn't be changed after it's been fingerprinted
+        if self._fingerprint is None:
+            self._fingerprint = serializer.fingerprint(self)
+        return self._fingerprint
+
+    def _init_clients_index(self):
+        # live clients of db users, {inbound_tag: {user_id: client}}
+        self._clients_index = None
+        self._clients_built_at = None
+        self._clients_invalidated = False
+        self._changed_user_ids = set()
+        self._clients_lock = threading.Lock()
+        self._clients_build_lock = threading.Lock()
+
+    def __deepcopy__(self, memo):
+        config = XRayConfig.__new__(XRayConfig)
+        dict.update(config, deepcopy(dict(self), memo))
+        for key, value in self.__dict__.items():
+            if not key.startswith('_clients') and key != '_changed_user_ids':
+                config.__dict__[key] = deepcopy(value, memo)
+        config._fingerprint = None
+        config._init_clients_index()
+        return config
 
     def copy(self):
-        return deepcopy(self)
+        config = XRayConfig.__new__(XRayConfig)
+        dict.update(config, copy_mutable_sections(self))
+        config.__dict__.update(self.__dict__)
+        config._tag_indexes = {}
+        config._fingerprint = None
+        config.inbounds = list(self.inbounds)
+        config.inbounds_by_tag = dict(self.inbounds_by_tag)
+        config.inbounds_by_protocol = {k: list(v) for k, v in self.inbounds_by_protocol.items()}
+        config._fallbacks_inbound = config.get_inbound(XRAY_FALLBACKS_INBOUND_TAG)
+        config._init_clients_index()
+        return config
 
-    def include_db_users(self) -> XRayConfig:
-        config = self.copy()
+    def mark_users_changed(self, user_ids):
+        with self._clients_lock:
+            self._changed_user_ids.update(user_ids)
+
+    def invalidate_clients(self):
+        with self._clients_lock:
+            self._clients_invalidated = True
+
+    def _users_query(self, db, user_ids=None):
+        query = db.query(
+            db_models.User.id,
+            db_models.User.username,
+            func.lower(db_models.Proxy.type).label('type'),
+            db_models.Proxy.settings,
+            func.group_concat(db_models.excluded_inbounds_association.c.inbound_tag).label('excluded_inbound_tags')
+        ).join(
+            db_models.Proxy, db_models.User.id == db_models.Proxy.user_id
+        ).outerjoin(
+            db_models.excluded_inbounds_association,
+            db_models.Proxy.id == db_models.excluded_inbounds_association.c.proxy_id
+        ).filter(
+            db_models.User.status.in_([UserStatus.active, UserStatus.on_hold])
+        )
+        if user_ids is not None:
+            query = query.filter(db_models.User.id.in_(user_ids))
+
+        # rows are streamed from a server-side cursor instead of being loaded with .all()
+        return query.group_by(
+            func.lower(db_models.Proxy.type),
+            db_models.User.id,
+            db_models.User.username,
+            db_models.Proxy.settings,
+        ).yield_per(USERS_QUERY_CHUNK_SIZE)
+
+    def _index_clients(self, index: dict, rows):
+        for row in rows:
+            inbounds = self._compiled_inbounds_by_protocol.get(row.type)
+            if not inbounds:
+                continue
 
-        with GetDB() as db:
-            query = db.query(
-                db_models.User.id,
-                db_models.User.username,
-                func.lower(db_models.Proxy.type).label('type'),
-                db_models.Proxy.settings,
-                func.group_concat(db_models.excluded_inbounds_association.c.inbound_tag).label('excluded_inbound_tags')
-            ).join(
-                db_models.Proxy, db_models.User.id == db_models.Proxy.user_id
-            ).outerjoin(
-                db_models.excluded_inbounds_association,
-                db_models.Proxy.id == db_models.excluded_inbounds_association.c.proxy_id
-            ).filter(
-                db_models.User.status.in_([UserStatus.active, UserStatus.on_hold])
-            ).group_by(
-                func.lower(db_models.Proxy.type),
-                db_models.User.id,
-                db_models.User.username,
-                db_models.Proxy.settings,
-            )
-            result = query.all()
+            excluded_inbound_tags = row.excluded_inbound_tags.split(',') if row.excluded_inbound_tags else ()
+            user_id = row.id
+            settings = {"email": f"{user_id}.{row.username}", **row.settings}
+            if settings.get('flow'):
+                settings_without_flow = dict(settings)
+                del settings_without_flow['flow']
+            else:
+                settings_without_flow = settings
+
+            for inbound in inbounds:
+                if inbound.tag in excluded_inbound_tags:
+                    continue
 
-            grouped_data = defaultdict(list)
+                client = dict(settings if inbound.allows_flow else settings_without_flow)
+                try:
+                    index[inbound.tag][user_id] = client
+                except KeyError:
+                    index[inbound.tag] = {user_id: client}
 
-            for row in result:
-                grouped_data[row.type].append((
-                    row.id,
-                    row.username,
-                    row.settings,
-                    [i for i in row.excluded_inbound_tags.split(',') if i] if row.excluded_inbound_tags else None
-                ))
+    def _update_clients_index(self, db) -> dict:
+        user_change_tracker.subscribe(self)
 
-            for proxy_type, rows in grouped_data.items():
+        with self._clients_lock:
+            index = None if self._clients_invalidated else self._clients_index
+            if index is not None and XRAY_INCREMENTAL_CLIENTS_REBUILD and \
+                    time.monotonic() - self._clients_built_at >= XRAY_INCREMENTAL_CLIENTS_REBUILD:
+                index = None
+            changed_user_ids, self._changed_user_ids = self._changed_user_ids, set()
+            self._clients_invalidated = False
 
-                inbounds = self.inbounds_by_protocol.get(proxy_type)
-                if not inbounds:
-                    continue
+        if index is not None and len(changed_user_ids) > max(map(len, index.values()), default=0) // 4:
+            # rebuilding is cheaper than querying a large part of the users by id
+            index = None
+
+        try:
+            if index is None:
+                index = {}
+                self._index_clients(index, self._users_query(db))
+                built_at = time.monotonic()
+            else:
+                built_at = self._clients_built_at
+                if changed_user_ids:
+                    for clients in index.values():
+                        for user_id in changed_user_ids:
+                            clients.pop(user_id, None)
+                    user_ids = list(changed_user_ids)
+                    for i in range(0, len(user_ids), CHANGED_USERS_CHUNK_SIZE):
+                        self._index_clients(index, self._users_query(db, user_ids[i:i + CHANGED_USERS_CHUNK_SIZE]))
+        except Exception:
+            # the index may be half updated, it's rebuilt on the next call
+            with self._clients_lock:
+                self._changed_user_ids |= changed_user_ids
+                self._clients_invalidated = True
+                self._clients_index = None
+            raise
+
+        with self._clients_lock:
+            self._clients_index = index
+            self._clients_built_at = built_at
+
+        return index
+
+    def include_db_users(self, incremental: bool = XRAY_INCREMENTAL_CLIENTS) -> XRayConfig:
+        config = self.copy()
+
+        with GetDB() as db, (self._clients_build_lock if incremental else nullcontext()):
+            if incremental:
+                index = self._update_clients_index(db)
+            else:
+                index = {}
+                self._index_clients(index, self._users_query(db))
 
-                for inbound in inbounds:
-                    clients = config.get_inbound(inbound['tag'])['settings']['clients']
-
-                    for row in rows:
-                        user_id, username, settings, excluded_inbound_tags = row
-
-                        if excluded_inbound_tags and inbound['tag'] in excluded_inbound_tags:
-                            continue
-
-                        client = {
-                            "email": f"{user_id}.{username}",
-                            **settings
-                        }
-
-                        # XTLS currently only supports transmission methods of TCP and mKCP
-                        if client.get('flow') and (
-                                inbound.get('network', 'tcp') not in ('tcp', 'raw', 'kcp')
-                                or
-                                (
-                                    inbound.get('network', 'tcp') in ('tcp', 'raw', 'kcp')
-                                    and
-                                    inbound.get('tls') not in ('tls', 'reality')
-                                )
-                                or
-                                inbound.get('header_type') == 'http'
-                        ):
-                            del client['flow']
-
-                        clients.append(client)
+            for tag, clients in index.items():
+                config.get_inbound(tag)['settings']['clients'].extend(clients.values())
 
         if DEBUG:
             with open('generated_config-debug.json', 'w') as f:
@@ -1,49 +1,250 @@
 import atexit
+import base64
+import hashlib
 import os
 import re
+import selectors
+import socket
 import subprocess
 import threading
+import time
 from collections import deque
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeoutError
 from contextlib import contextmanager
+from functools import lru_cache
+
+try:
+    from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
+    from cryptography.hazmat.primitives.serialization import Encoding, NoEncryption, PrivateFormat, PublicFormat
+except ImportError:
+    X25519PrivateKey = None
+
+from xray_api import exceptions as xray_exc
 
 from app import logger
-from app.xray.config import XRayConfig
+from app.models.proxy import ProxyTypes
+from app.xray.access_log import XRAY_ACCESS_LOG_INDEX, AccessLogIndex
+from app.xray.binary import XRayBinaryInfo, probe_version
+from app.xray.config import XRayConfig, diff_inbound_clients
+from app.xray.hooks import HookRunner
+from app.xray.log_archive import XRAY_LOG_ARCHIVE_DIR, LogArchive
+from app.xray.logs import DROP_OLDEST, LogBroadcaster, LogSubscription
+from app.xray.metrics import start_exporter
+from app.xray.presence import XRAY_PRESENCE_TRACKER, PresenceTracker
+from app.xray.scheduler import RestartScheduler
 
 DEBUG = os.environ.get("DEBUG", "false").lower() == "true"
 
+XRAY_RESTART_DEBOUNCE = float(os.environ.get("XRAY_RESTART_DEBOUNCE", 0.5))
+
+# client changes above this count are applied with a restart, each of them is an API call
+XRAY_HOT_RELOAD_MAX_CHANGES = int(os.environ.get("XRAY_HOT_RELOAD_MAX_CHANGES", 500))
+
+XRAY_READY_TIMEOUT = float(os.environ.get("XRAY_READY_TIMEOUT", 30))
+READY_PROBE_INTERVAL = 0.1
+
+XRAY_STOP_TIMEOUT = float(os.environ.get("XRAY_STOP_TIMEOUT", 10))
+
+# restart xray when it exits unexpectedly, with exponential backoff
+XRAY_SUPERVISE = os.environ.get("XRAY_SUPERVISE", "false").lower() == "true"
+XRAY_SUPERVISOR_BACKOFF = 1
+XRAY_SUPERVISOR_MAX_BACKOFF = 60
+XRAY_SUPERVISOR_STABLE_UPTIME = 60
+XRAY_SUPERVISOR_CRASH_LOOP = 5
+
+# on start/stop functions run on a bounded pool, longer running ones are reported
+XRAY_HOOK_WORKERS = int(os.environ.get("XRAY_HOOK_WORKERS", 4))
+XRAY_HOOK_TIMEOUT = float(os.environ.get("XRAY_HOOK_TIMEOUT", 60))
+
+LOG_READ_SIZE = 64 * 1024
+MAX_LOG_LINE_SIZE = 64 * 1024
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+
+def _encode_keypair(key) -> tuple:
+    return (
+        _b64encode(key.private_bytes(Encoding.Raw, PrivateFormat.Raw, NoEncryption())),
+        _b64encode(key.public_key().public_bytes(Encoding.Raw, PublicFormat.Raw))
+    )
+
+
+@lru_cache(maxsize=256)
+def _derive_x25519(private_key: str):
+    try:
+        return _encode_keypair(X25519PrivateKey.from_private_bytes(_b64decode(private_key)))
+    except ValueError:
+        return None
+
+
+def x25519_keypair(private_key: str = None):
+    """
+    Generates a key pair or derives the public key of private_key in-process,
+    keys are encoded the same way `xray x25519` does (base64 raw url encoding).
+    Returns None if cryptography isn't available or the key is invalid.
+    """
+    if X25519PrivateKey is None:
+        return None
+
+    if private_key:
+        keypair = _derive_x25519(private_key)
+    else:
+        keypair = _encode_keypair(X25519PrivateKey.generate())
+
+    if keypair:
+        return {
+            "private_key": keypair[0],
+            "public_key": keypair[1]
+        }
+
+
+class LogCaptureStats:
+    """Counters of the captured xray output, rates are of the last full second."""
+
+    def __init__(self):
+        self.lines = 0
+        self.bytes = 0
+        self.lines_per_second = 0.0
+        self.bytes_per_second = 0.0
+        self._window_start = time.monotonic()
+        self._window_lines = 0
+        self._window_bytes = 0
+
+    def add(self, lines: int, size: int):
+        self.lines += lines
+        self.bytes += size
+        self._window_lines += lines
+        self._window_bytes += size
+        self._roll()
+
+    def _roll(self):
+        now = time.monotonic()
+        elapsed = now - self._window_start
+        if elapsed < 1:
+            return
+        self.lines_per_second = self._window_lines / elapsed
+        self.bytes_per_second = self._window_bytes / elapsed
+        self._window_start = now
+        self._window_lines = 0
+        self._window_bytes = 0
+
+    def as_dict(self) -> dict:
+        self._roll()
+        return {
+            "lines": self.lines,
+            "bytes": self.bytes,
+            "lines_per_second": self.lines_per_second,
+            "bytes_per_second": self.bytes_per_second
+        }
+
 
 class XRayCore:
     def __init__(self,
                  executable_path: str = None,
-                 assets_path: str = "/usr/share/xray"):
+                 assets_path: str = "/usr/share/xray",
+                 supervise: bool = None,
+                 log_archive: LogArchive = None,
+                 access_log: AccessLogIndex = None):
         self.executable_path = executable_path or os.environ.get('XRAY_EXECUTABLE_PATH', "/usr/bin/xray")
-        self.version = self.get_version()
+        self.binary = XRayBinaryInfo(self.executable_path)
+        self.binary.load()
         self.process = None
         self.restarting = False
+        self.config = None
+        self.reload_stats = {"hot_applied": 0, "restarted": 0, "too_many_changes": 0, "hot_apply_failed": 0}
+        self.restart_scheduler = RestartScheduler(self, debounce=XRAY_RESTART_DEBOUNCE)
+        self._restart_lock = threading.RLock()
+
+        self.ready = None
+        self.time_to_ready = None
+        self.config_size = None
+        self.config_fingerprint = None
+        self.node_fingerprints = {}
+        self.skipped_restarts = 0
+        # (config size, seconds until the API was ready) of recent starts
+        self.startup_history = deque(maxlen=50)
+        self._x25519_cache = {}
+
+        self.supervise = XRAY_SUPERVISE if supervise is None else supervise
+        self.last_crash = None
+        self.lifecycle_stats = {
+            "stops": 0,
+            "killed": 0,
+            "last_stop_duration": None,
+            "crashes": 0,
+            "crash_loops": 0,
+            "supervisor_restarts": 0,
+            "restarts": 0,
+            "last_restart_duration": None
+        }
+        self._started_at = None
+        self._consecutive_crashes = 0
 
         self._logs_buffer = deque(maxlen=100)
-        self._temp_log_buffers = {}
+        self._log_stats = LogCaptureStats()
+        self._log_broadcaster = LogBroadcaster()
+        # functions called with every batch of captured lines, they must not block
+        self._log_sinks = []
+        self.log_archive = log_archive
+        if self.log_archive is None and XRAY_LOG_ARCHIVE_DIR:
+            self.log_archive = LogArchive(XRAY_LOG_ARCHIVE_DIR)
+        if self.log_archive is not None:
+            self.add_log_sink(self.log_archive.append)
+        self.access_log = access_log
+        if self.access_log is None and XRAY_ACCESS_LOG_INDEX:
+            self.access_log = AccessLogIndex()
+        if self.access_log is not None:
+            self.add_log_sink(self.access_log.feed)
         self._on_start_funcs = []
         self._on_stop_funcs = []
+        self._hooks = HookRunner(max_workers=XRAY_HOOK_WORKERS, timeout=XRAY_HOOK_TIMEOUT)
         self._env = {
             "XRAY_LOCATION_ASSET": assets_path
         }
 
-        atexit.register(lambda: self.stop() if self.started else None)
+        self.presence = PresenceTracker(self)
+        if XRAY_PRESENCE_TRACKER:
+            self.on_start(self.presence.start)
+
+        # served on XRAY_METRICS_LISTEN if it's set
+        self.metrics = start_exporter(self)
+
+        atexit.register(self._shutdown)
+
+    def _shutdown(self):
+        if self.started:
+            self.stop()
+        if self.presence.running:
+            self.presence.flush()
+
+    @property
+    def version(self) -> str:
+        return self.binary.version
 
     def get_version(self):
-        try:
-            cmd = [self.executable_path, "version"]
-            output = subprocess.check_output(cmd, stderr=subprocess.STDOUT).decode('utf-8')
-            m = re.search(r'Xray (\d+\.\d+\.\d+)', output)
-            if m:
-                return m.group(1)
-            return "unknown"
-        except Exception as e:
-            logger.error(f"Error getting Xray version: {e}")
-            return "error"
+        return probe_version(self.executable_path)
 
     def get_x25519(self, private_key: str = None):
+        keypair = x25519_keypair(private_key)
+        if keypair:
+            return keypair
+
+        # fallback to the binary, derived public keys are remembered
+        if private_key:
+            digest = hashlib.sha256(private_key.encode()).hexdigest()
+            if digest in self._x25519_cache:
+                return self._x25519_cache[digest]
+
+        if self.binary.commands and not self.binary.supports("x25519"):
+            return None
+
         cmd = [self.executable_path, "x25519"]
         if private_key:
             cmd.extend(['-i', private_key])
@@ -52,55 +253,105 @@ class XRayCore:
             m_priv = re.search(r'Private\s*key:\s*(\S+)', output, re.IGNORECASE)
             m_pub = re.search(r'(?:Password|Public\s*key):\s*(\S+)', output, re.IGNORECASE)
             if m_priv and m_pub:
-                return {
+                keypair = {
                     "private_key": m_priv.group(1),
                     "public_key": m_pub.group(1)
                 }
+                if private_key:
+                    self._x25519_cache[digest] = keypair
+                return keypair
         except Exception as e:
             logger.error(f"DEBUG: Error running x25519: {e}")
         return None
 
     def __capture_process_logs(self):
-        def capture_and_debug_log():
-            while self.process:
-                output = self.process.stdout.readline()
-                if output:
-                    output = output.strip()
-                    self._logs_buffer.append(output)
-                    for buf in list(self._temp_log_buffers.values()):
-                        buf.append(output)
-                    logger.debug(output)
-
-                elif not self.process or self.process.poll() is not None:
-                    break
-
-        def capture_only():
-            while self.process:
-                output = self.process.stdout.readline()
-                if output:
-                    output = output.strip()
-                    self._logs_buffer.append(output)
-                    for buf in list(self._temp_log_buffers.values()):
-                        buf.append(output)
-
-                elif not self.process or self.process.poll() is not None:
-                    break
+        threading.Thread(target=self._capture_process_logs, args=(self.process,), daemon=True).start()
+
+    def _capture_process_logs(self, process: subprocess.Popen):
+        # stdout and stderr are drained together, so a chatty stderr can't fill its pipe and stall xray
+        selector = selectors.DefaultSelector()
+        pending = {}
+        for stream in (process.stdout, process.stderr):
+            os.set_blocking(stream.fileno(), False)
+            selector.register(stream, selectors.EVENT_READ)
+            pending[stream] = b''
+
+        try:
+            while selector.get_map():
+                for key, _ in selector.select(timeout=1):
+                    stream = key.fileobj
+                    try:
+                        data = os.read(key.fd, LOG_READ_SIZE)
+                    except BlockingIOError:
+                        continue
+
+                    if not data:
+                        selector.unregister(stream)
+                        if pending[stream]:
+                            self._dispatch_logs([pending[stream]], 0)
+                        continue
+
+                    *lines, pending[stream] = (pending[stream] + data).split(b'\n')
+                    if len(pending[stream]) > MAX_LOG_LINE_SIZE:
+                        lines.append(pending[stream][:MAX_LOG_LINE_SIZE])
+                        pending[stream] = b''
+                    self._dispatch_logs(lines, len(data))
+        finally:
+            selector.close()
+
+        self._on_process_exit(process)
+
+    def _dispatch_logs(self, lines: list, size: int):
+        lines = [line.strip() for line in b'\n'.join(lines).decode('utf-8', 'replace').split('\n')]
+        lines = [line for line in lines if line]
+        self._log_stats.add(len(lines), size)
+        if not lines:
+            return
+
+        self._logs_buffer.extend(lines)
+        self._log_broadcaster.publish(lines)
+        for sink in self._log_sinks:
+            try:
+                sink(lines)
+            except Exception as e:
+                logger.error(f"Xray log sink {sink} failed: {e}")
 
         if DEBUG:
-            threading.Thread(target=capture_and_debug_log).start() 
-        else:
-            threading.Thread(target=capture_only).start()
+            for line in lines:
+                logger.debug(line)
+
+    @property
+    def log_stats(self) -> dict:
+        return {
+            **self._log_stats.as_dict(),
+            **self._log_broadcaster.stats()
+        }
+
+    def add_log_sink(self, func: callable):
+        self._log_sinks.append(func)
+        return func
+
+    def remove_log_sink(self, func: callable):
+        self._log_sinks.remove(func)
+
+    def subscribe_logs(self, maxlen: int = 100, history: int = 100, overflow: str = DROP_OLDEST) -> LogSubscription:
+        return self._log_broadcaster.subscribe(maxlen=maxlen, history=history, overflow=overflow)
 
     @contextmanager
     def get_logs(self):
-        buf = deque(self._logs_buffer, maxlen=100)
-        buf_id = id(buf)
+        subscription = self.subscribe_logs()
         try:
-            self._temp_log_buffers[buf_id] = buf
-            yield buf
+            yield subscription
         finally:
-            del self._temp_log_buffers[buf_id]
-            del buf
+            subscription.close()
+
+    @property
+    def pid(self):
+        return self.process.pid if self.started else None
+
+    @property
+    def uptime(self):
+        return time.monotonic() - self._started_at if self.started else None
 
     @property
     def started(self):
@@ -112,12 +363,25 @@ class XRayCore:
 
         return False
 
-    def start(self, config: XRayConfig):
+    @staticmethod
+    def _prepare_config(config: XRayConfig):
+        if config.get('log', {}).get('logLevel') in ('none', 'error'):
+            config['log']['logLevel'] = 'warning'
+            config._fingerprint = None
+
+    def start(self, config: XRayConfig, wait: float = None) -> Future:
+        """
+        Starts xray and returns a future which resolves to True once the API
+        inbound accepts connections, or to False if xray exits or doesn't get
+        ready in time. On start functions are executed after it's ready.
+        With wait given, blocks up to wait seconds for the readiness.
+        """
         if self.started is True:
             raise RuntimeError("Xray is started already")
 
-        if config.get('log', {}).get('logLevel') in ('none', 'error'):
-            config['log']['logLevel'] = 'warning'
+        self._prepare_config(config)
+        # a private copy, callers go on mutating theirs (nodes inline TLS certificates into streamSettings)
+        self.config = config.copy()
 
         cmd = [
             self.executable_path,
@@ -125,48 +389,267 @@ class XRayCore:
             '-config',
             'stdin:'
         ]
+        started_at = self._started_at = time.monotonic()
         self.process = subprocess.Popen(
             cmd,
             env=self._env,
             stdin=subprocess.PIPE,
             stderr=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            universal_newlines=True
+            stdout=subprocess.PIPE
         )
-        self.process.stdin.write(config.to_json())
-        self.process.stdin.flush()
+        # stream the config straight into the pipe instead of building one big string,
+        # keys are sorted so the fingerprint of the written config is canonical
+        digest = hashlib.sha256()
+        self.config_size = config.write_json(self.process.stdin, sort_keys=True, digest=digest)
+        self.config_fingerprint = config._fingerprint = self.config._fingerprint = digest.hexdigest()
         self.process.stdin.close()
-        logger.warning(f"Xray core {self.version} started")        
+        logger.warning(f"Xray core {self.version} started")
 
         self.__capture_process_logs()
 
+        self.ready = Future()
+        self.time_to_ready = None
+        threading.Thread(
+            target=self._wait_ready,
+            args=(self.process, self.ready, config, started_at),
+            daemon=True
+        ).start()
+
+        if wait:
+            try:
+                self.ready.result(timeout=wait)
+            except FutureTimeoutError:
+                pass
+        return self.ready
+
+    def _probe_api(self, config: XRayConfig) -> bool:
+        try:
+            with socket.create_connection(config.api_address, timeout=READY_PROBE_INTERVAL):
+                return True
+        except OSError:
+            return False
+
+    def _wait_ready(self, process: subprocess.Popen, ready: Future, config: XRayConfig, started_at: float):
+        deadline = started_at + XRAY_READY_TIMEOUT
+        while True:
+            if process is not self.process:
+                # stopped or replaced by another start in the meantime
+                if not ready.done():
+                    ready.set_result(False)
+                return
+
+            if process.poll() is not None:
+                logger.error(f"Xray core exited with code {process.returncode} before getting ready")
+                if not ready.done():
+                    ready.set_result(False)
+                return
+
+            if self._probe_api(config):
+                break
+
+            if not ready.done() and time.monotonic() >= deadline:
+                # waiting goes on, a big config may just take longer to load
+                logger.error(f"Xray core API isn't ready after {XRAY_READY_TIMEOUT} seconds")
+                ready.set_result(False)
+            time.sleep(READY_PROBE_INTERVAL)
+
+        self.time_to_ready = time.monotonic() - started_at
+        self.startup_history.append((self.config_size, self.time_to_ready))
+        logger.info(f"Xray core is ready in {self.time_to_ready:.2f}s")
+        if not ready.done():
+            ready.set_result(True)
+
+        if process is not self.process:
+            return
+
         # execute on start functions
-        for func in self._on_start_funcs:
-            threading.Thread(target=func).start()
+        self._hooks.run(self._on_start_funcs)
 
     def stop(self):
         if not self.started:
+            # also cancels a pending restart of a crashed process
+            self.process = None
             return
 
-        self.process.terminate()
-        self.process = None
+        process, self.process = self.process, None
+        stopped_at = time.monotonic()
+        process.terminate()
+        try:
+            process.wait(timeout=XRAY_STOP_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            logger.warning(f"Xray core didn't stop in {XRAY_STOP_TIMEOUT} seconds, killing it")
+            process.kill()
+            process.wait()
+            self.lifecycle_stats["killed"] += 1
+
+        self.lifecycle_stats["stops"] += 1
+        self.lifecycle_stats["last_stop_duration"] = time.monotonic() - stopped_at
         logger.warning("Xray core stopped")
 
         # execute on stop functions
-        for func in self._on_stop_funcs:
-            threading.Thread(target=func).start()
+        self._hooks.run(self._on_stop_funcs)
 
-    def restart(self, config: XRayConfig):
-        if self.restarting is True:
+    def _on_process_exit(self, process: subprocess.Popen):
+        returncode = process.wait()
+        if process is not self.process:
+            # stopped or replaced on purpose
             return
 
-        try:
-            self.restarting = True
-            logger.warning("Restarting Xray core...")
-            self.stop()
-            self.start(config)
-        finally:
-            self.restarting = False
+        uptime = time.monotonic() - self._started_at
+        self.lifecycle_stats["crashes"] += 1
+        self.last_crash = {
+            "returncode": returncode,
+            "time": time.time(),
+            "uptime": uptime,
+            "logs": list(self._logs_buffer)
+        }
+        logger.error(f"Xray core exited unexpectedly with code {returncode} after {uptime:.1f}s")
+        if self.log_archive is not None:
+            # keep what xray printed before crashing even if the panel goes down too
+            self.log_archive.flush()
+
+        if not self.supervise:
+            return
+
+        if uptime >= XRAY_SUPERVISOR_STABLE_UPTIME:
+            self._consecutive_crashes = 0
+        self._consecutive_crashes += 1
+        if self._consecutive_crashes == XRAY_SUPERVISOR_CRASH_LOOP:
+            self.lifecycle_stats["crash_loops"] += 1
+            logger.error(f"Xray core is crash looping, {self._consecutive_crashes} crashes in a row")
+
+        delay = min(XRAY_SUPERVISOR_BACKOFF * 2 ** (self._consecutive_crashes - 1), XRAY_SUPERVISOR_MAX_BACKOFF)
+        logger.warning(f"Restarting crashed Xray core in {delay:.1f}s")
+        timer = threading.Timer(delay, self._restart_crashed, args=(process,))
+        timer.daemon = True
+        timer.start()
+
+    def _restart_crashed(self, process: subprocess.Popen):
+        with self._restart_lock:
+            if process is not self.process:
+                # restarted or stopped in the meantime
+                return
+            self.process = None
+            self.lifecycle_stats["supervisor_restarts"] += 1
+            try:
+                self.start(self.config)
+            except Exception as e:
+                logger.error(f"Unable to restart crashed Xray core: {e}")
+
+    def is_running_config(self, config: XRayConfig) -> bool:
+        return self.started and self.config_fingerprint is not None \
+            and config.fingerprint() == self.config_fingerprint
+
+    def restart(self, config: XRayConfig):
+        self._prepare_config(config)
+
+        # concurrent restarts wait for each other instead of dropping the newer config
+        with self._restart_lock:
+            try:
+                self.restarting = True
+                logger.warning("Restarting Xray core...")
+                restarted_at = time.monotonic()
+                self.stop()
+                self.start(config)
+                self.lifecycle_stats["restarts"] += 1
+                self.lifecycle_stats["last_restart_duration"] = time.monotonic() - restarted_at
+            finally:
+                self.restarting = False
+
+    def restart_if_changed(self, config: XRayConfig) -> bool:
+        """
+        Restarts xray unless it's already running the same config,
+        tells whether it was restarted.
+        """
+        self._prepare_config(config)
+
+        with self._restart_lock:
+            if self.is_running_config(config):
+                self.skipped_restarts += 1
+                logger.info("Xray config didn't change, restart skipped")
+                return False
+            self.restart(config)
+            return True
+
+    def schedule_restart(self, config: XRayConfig, api=None, skip_unchanged: bool = False) -> Future:
+        """
+        Debounced restart, bursts of requests are coalesced and only the latest
+        config is applied. With api given, the config is hot-applied when possible.
+        With skip_unchanged, or api, nothing is done if the config didn't change.
+        """
+        return self.restart_scheduler.submit(config, api=api, skip_unchanged=skip_unchanged)
+
+    def _hot_apply(self, changes: dict, api):
+        for tag, (added, removed) in changes.items():
+            protocol = ProxyTypes(self.config.get_inbound(tag)['protocol'])
+            for email in removed:
+                try:
+                    api.remove_inbound_user(tag=tag, email=email, timeout=30)
+                except xray_exc.EmailNotFoundError:
+                    pass
+            for client in added:
+                try:
+                    api.add_inbound_user(tag=tag, user=protocol.account_model(**client), timeout=30)
+                except xray_exc.EmailExistsError:
+                    pass
+
+    def reload(self, config: XRayConfig, api=None):
+        """
+        Applies config changes through the Xray API when only inbounds' clients
+        have changed, so live connections of other users are kept.
+        Falls back to a full restart for anything else.
+        """
+        self._prepare_config(config)
+
+        with self._restart_lock:
+            if self.is_running_config(config):
+                self.skipped_restarts += 1
+                logger.info("Xray config didn't change, reload skipped")
+                return
+
+            if api is not None and self.started and self.config is not None:
+                changes = diff_inbound_clients(self.config, config)
+                changes_count = sum(len(added) + len(removed) for added, removed in (changes or {}).values())
+                if changes_count > XRAY_HOT_RELOAD_MAX_CHANGES:
+                    # thousands of sequential API calls would hold the restart lock for minutes
+                    self.reload_stats["too_many_changes"] += 1
+                    logger.info(f"{changes_count} Xray client changes are too many to hot-apply, restarting")
+                elif changes is not None:
+                    try:
+                        self._hot_apply(changes, api)
+                        self.config_fingerprint = config.fingerprint()
+                        self.config = config.copy()
+                        self.config._fingerprint = self.config_fingerprint
+                        self.reload_stats["hot_applied"] += 1
+                        logger.info(f"Xray config hot-applied, {len(changes)} inbound(s) changed")
+                        return
+                    except Exception as e:
+                        self.reload_stats["hot_apply_failed"] += 1
+                        logger.error(f"Unable to hot-apply Xray config, restarting: {e}")
+
+            self.reload_stats["restarted"] += 1
+            self.restart(config)
+
+    def node_config_changed(self, node_id: int, config: XRayConfig) -> bool:
+        """
+        Tells whether config differs from the one last pushed to the node
+        and remembers it as pushed if so.
+        """
+        if self.node_fingerprints.get(node_id) == config.fingerprint():
+            self.skipped_restarts += 1
+            return False
+        self.remember_node_config(node_id, config)
+        return True
+
+    def remember_node_config(self, node_id: int, config: XRayConfig):
+        self.node_fingerprints[node_id] = config.fingerprint()
+
+    def forget_node_config(self, node_id: int):
+        self.node_fingerprints.pop(node_id, None)
+
+    @property
+    def hook_stats(self) -> dict:
+        return self._hooks.stats()
 
     def on_start(self, func: callable):
         self._on_start_funcs.append(func)
@@ -0,0 +1,118 @@
+import threading
+import time
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
+
+from app import logger
+
+DURATION_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60)
+
+
+class HookStats:
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.coalesced = 0
+        self.total_duration = 0.0
+        self.max_duration = 0.0
+        # counts of durations <= DURATION_BUCKETS[i], the last one is +Inf
+        self.buckets = [0] * (len(DURATION_BUCKETS) + 1)
+
+    def observe(self, duration: float):
+        self.calls += 1
+        self.total_duration += duration
+        self.max_duration = max(self.max_duration, duration)
+        self.buckets[bisect_left(DURATION_BUCKETS, duration)] += 1
+
+    def as_dict(self) -> dict:
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "timeouts": self.timeouts,
+            "coalesced": self.coalesced,
+            "total_duration": self.total_duration,
+            "max_duration": self.max_duration,
+            "buckets": dict(zip([*map(str, DURATION_BUCKETS), "+Inf"], self.buckets))
+        }
+
+
+class HookRunner:
+    """
+    Runs on start/stop functions on a bounded thread pool. A hook which is
+    still queued when it's triggered again isn't queued twice, hooks running
+    longer than timeout are reported (threads can't be interrupted, so they
+    keep running). Durations are kept as per-hook histograms.
+    """
+
+    def __init__(self, max_workers: int = 4, timeout: float = 60):
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="xray-hook")
+        self._lock = threading.Lock()
+        self._queued = set()
+        self._running = {}
+        self._stats = {}
+        self._watchdog = None
+
+    @staticmethod
+    def _name(func: callable) -> str:
+        return f"{getattr(func, '__module__', '')}.{getattr(func, '__qualname__', repr(func))}"
+
+    def _get_stats(self, func: callable) -> HookStats:
+        try:
+            return self._stats[func]
+        except KeyError:
+            return self._stats.setdefault(func, HookStats())
+
+    def run(self, funcs: list):
+        with self._lock:
+            for func in funcs:
+                if func in self._queued:
+                    self._get_stats(func).coalesced += 1
+                    continue
+                self._queued.add(func)
+                self._executor.submit(self._call, func)
+
+            if self._watchdog is None and self.timeout:
+                self._watchdog = threading.Thread(target=self._watch, daemon=True)
+                self._watchdog.start()
+
+    def _call(self, func: callable):
+        started_at = time.monotonic()
+        # [func, deadline, reported as timed out]
+        entry = [func, started_at + self.timeout if self.timeout else None, False]
+        with self._lock:
+            self._queued.discard(func)
+            self._running[id(entry)] = entry
+
+        error = None
+        try:
+            func()
+        except Exception as e:
+            error = e
+            logger.exception(f"Xray hook {self._name(func)} failed: {e}")
+        finally:
+            duration = time.monotonic() - started_at
+            with self._lock:
+                del self._running[id(entry)]
+                stats = self._get_stats(func)
+                stats.observe(duration)
+                if error is not None:
+                    stats.errors += 1
+
+    def _watch(self):
+        while True:
+            time.sleep(min(self.timeout, 1))
+            now = time.monotonic()
+            with self._lock:
+                for entry in self._running.values():
+                    func, deadline, reported = entry
+                    if reported or deadline is None or deadline > now:
+                        continue
+                    entry[2] = True
+                    self._get_stats(func).timeouts += 1
+                    logger.error(f"Xray hook {self._name(func)} is running longer than {self.timeout}s")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {self._name(func): stats.as_dict() for func, stats in self._stats.items()}
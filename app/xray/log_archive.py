@@ -0,0 +1,258 @@
+import glob
+import gzip
+import os
+import queue
+import threading
+import time
+from bisect import bisect_right
+from datetime import datetime
+from typing import Iterator, List, Tuple
+
+from app import logger
+
+# directory of the archive, empty to disable it
+XRAY_LOG_ARCHIVE_DIR = os.environ.get("XRAY_LOG_ARCHIVE_DIR", "")
+XRAY_LOG_ARCHIVE_SEGMENT_SIZE = int(os.environ.get("XRAY_LOG_ARCHIVE_SEGMENT_SIZE", 16 * 1024 * 1024))
+XRAY_LOG_ARCHIVE_SEGMENT_AGE = float(os.environ.get("XRAY_LOG_ARCHIVE_SEGMENT_AGE", 3600))
+XRAY_LOG_ARCHIVE_SEGMENTS = int(os.environ.get("XRAY_LOG_ARCHIVE_SEGMENTS", 48))
+
+BLOCK_SIZE = 256 * 1024  # uncompressed bytes per gzip member
+BLOCK_INTERVAL = 5  # seconds before a partial block is written
+QUEUE_SIZE = 10000  # batches of lines
+
+_FLUSH = object()
+
+
+class Segment:
+    """
+    A file of concatenated gzip members (blocks), which is itself a valid
+    gzip file. Its .idx sidecar has a line per block: first and last
+    timestamp, offset and compressed size, so a time range only needs the
+    blocks overlapping it to be read and decompressed.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.index_path = path + ".idx"
+        self.blocks: List[Tuple[float, float, int, int]] = []
+        self.size = 0
+
+    @property
+    def first_ts(self) -> float:
+        return self.blocks[0][0] if self.blocks else None
+
+    @property
+    def last_ts(self) -> float:
+        return self.blocks[-1][1] if self.blocks else None
+
+    def load_index(self):
+        try:
+            with open(self.index_path) as file:
+                for line in file:
+                    first_ts, last_ts, offset, length = line.split()
+                    self.blocks.append((float(first_ts), float(last_ts), int(offset), int(length)))
+        except (OSError, ValueError):
+            pass
+        self.size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        # drop a block whose write was interrupted
+        while self.blocks and self.blocks[-1][2] + self.blocks[-1][3] > self.size:
+            self.blocks.pop()
+
+    def append(self, first_ts: float, last_ts: float, data: bytes):
+        compressed = gzip.compress(data, compresslevel=6)
+        with open(self.path, 'ab') as file:
+            offset = file.tell()
+            file.write(compressed)
+        block = (first_ts, last_ts, offset, len(compressed))
+        with open(self.index_path, 'a') as file:
+            file.write("%.6f %.6f %d %d\n" % block)
+        self.blocks.append(block)
+        self.size = offset + len(compressed)
+
+    def read_block(self, block: tuple) -> List[Tuple[float, str]]:
+        with open(self.path, 'rb') as file:
+            file.seek(block[2])
+            data = gzip.decompress(file.read(block[3]))
+        return list(_decode_lines(data))
+
+    def blocks_between(self, start: float, end: float) -> List[tuple]:
+        # blocks are in time order, the first candidate is found by bisecting the last timestamps
+        first = bisect_right([block[1] for block in self.blocks], start) if start is not None else 0
+        return [block for block in self.blocks[first:] if end is None or block[0] <= end]
+
+    def remove(self):
+        for path in (self.path, self.index_path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def _encode_lines(records: List[Tuple[float, str]]) -> bytes:
+    return "".join("%.6f\t%s\n" % record for record in records).encode('utf-8', 'replace')
+
+
+def _decode_lines(data: bytes) -> Iterator[Tuple[float, str]]:
+    for line in data.decode('utf-8', 'replace').splitlines():
+        ts, _, text = line.partition('\t')
+        try:
+            yield float(ts), text
+        except ValueError:
+            continue
+
+
+class LogArchive:
+    """
+    Disk archive of Xray output, fed as a log sink of XRayCore. append()
+    only puts the lines on a bounded queue, a background writer packs them
+    into gzip blocks of rotating segments (by size and age), so capture is
+    never blocked by the disk; batches are dropped and counted when the
+    writer can't keep up. Segments over the limit are removed, oldest first.
+    """
+
+    def __init__(self,
+                 directory: str = XRAY_LOG_ARCHIVE_DIR,
+                 segment_size: int = XRAY_LOG_ARCHIVE_SEGMENT_SIZE,
+                 segment_age: float = XRAY_LOG_ARCHIVE_SEGMENT_AGE,
+                 max_segments: int = XRAY_LOG_ARCHIVE_SEGMENTS):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.segment_age = segment_age
+        self.max_segments = max_segments
+
+        self._queue = queue.Queue(maxsize=QUEUE_SIZE)
+        self._lock = threading.Lock()
+        self._segments: List[Segment] = []
+        self._segment_started_at = None
+        self._pending: List[Tuple[float, str]] = []
+        self._pending_size = 0
+        self._pending_since = None
+
+        self.archived_lines = 0
+        self.dropped_lines = 0
+        self.write_errors = 0
+
+        os.makedirs(directory, exist_ok=True)
+        for path in sorted(glob.glob(os.path.join(directory, "xray-*.log.gz"))):
+            segment = Segment(path)
+            segment.load_index()
+            self._segments.append(segment)
+
+        self._thread = threading.Thread(target=self._run, daemon=True, name="xray-log-archive")
+        self._thread.start()
+
+    def append(self, lines: List[str]):
+        try:
+            self._queue.put_nowait((time.time(), lines))
+        except queue.Full:
+            self.dropped_lines += len(lines)
+
+    def flush(self):
+        """Asks the writer to write the partial block, e.g. after a crash."""
+        try:
+            self._queue.put_nowait(_FLUSH)
+        except queue.Full:
+            pass
+
+    def _run(self):
+        while True:
+            try:
+                item = self._queue.get(timeout=BLOCK_INTERVAL)
+            except queue.Empty:
+                item = None
+
+            with self._lock:
+                if item is _FLUSH:
+                    self._write_block()
+                    continue
+                if item is not None:
+                    ts, lines = item
+                    if self._pending_since is None:
+                        self._pending_since = time.monotonic()
+                    for line in lines:
+                        self._pending.append((ts, line))
+                        self._pending_size += len(line) + 20
+                if self._pending_size >= BLOCK_SIZE or (
+                        self._pending_since is not None
+                        and time.monotonic() - self._pending_since >= BLOCK_INTERVAL):
+                    self._write_block()
+
+    def _current_segment(self) -> Segment:
+        now = time.time()
+        segment = self._segments[-1] if self._segments else None
+        if segment is None or segment.size >= self.segment_size \
+                or self._segment_started_at is None or now - self._segment_started_at >= self.segment_age:
+            name = datetime.utcfromtimestamp(now).strftime("xray-%Y%m%d-%H%M%S-%f.log.gz")
+            segment = Segment(os.path.join(self.directory, name))
+            self._segments.append(segment)
+            self._segment_started_at = now
+            while len(self._segments) > self.max_segments:
+                self._segments.pop(0).remove()
+        return segment
+
+    def _write_block(self):
+        # called with the lock acquired
+        if not self._pending:
+            return
+        records, self._pending = self._pending, []
+        self._pending_size = 0
+        self._pending_since = None
+        try:
+            self._current_segment().append(records[0][0], records[-1][0], _encode_lines(records))
+            self.archived_lines += len(records)
+        except OSError as e:
+            self.write_errors += 1
+            self.dropped_lines += len(records)
+            logger.error(f"Unable to archive Xray logs: {e}")
+
+    def range(self, start: float = None, end: float = None, limit: int = None) -> List[Tuple[float, str]]:
+        """(timestamp, line) records with start <= timestamp <= end, oldest first."""
+        with self._lock:
+            segments = [s for s in self._segments if s.blocks
+                        and (start is None or s.last_ts >= start) and (end is None or s.first_ts <= end)]
+            blocks = [(segment, segment.blocks_between(start, end)) for segment in segments]
+            pending = list(self._pending)
+
+        result = []
+        for segment, segment_blocks in blocks:
+            for block in segment_blocks:
+                try:
+                    records = segment.read_block(block)
+                except (OSError, EOFError, gzip.BadGzipFile):
+                    # removed by rotation in the meantime
+                    continue
+                result.extend(r for r in records if (start is None or r[0] >= start) and (end is None or r[0] <= end))
+                if limit is not None and len(result) >= limit:
+                    return result[:limit]
+        result.extend(r for r in pending if (start is None or r[0] >= start) and (end is None or r[0] <= end))
+        return result if limit is None else result[:limit]
+
+    def tail(self, lines: int = 100) -> List[Tuple[float, str]]:
+        """The last archived lines, oldest first, including the ones not written yet."""
+        with self._lock:
+            result = list(self._pending[-lines:])
+            blocks = [(segment, block) for segment in self._segments for block in segment.blocks]
+
+        for segment, block in reversed(blocks):
+            if len(result) >= lines:
+                break
+            try:
+                result[:0] = segment.read_block(block)
+            except (OSError, EOFError, gzip.BadGzipFile):
+                continue
+        return result[-lines:]
+
+    def stats(self) -> dict:
+        with self._lock:
+            segments = len(self._segments)
+            size = sum(segment.size for segment in self._segments)
+            pending = len(self._pending)
+        return {
+            "segments": segments,
+            "size": size,
+            "archived_lines": self.archived_lines,
+            "pending_lines": pending,
+            "queued_batches": self._queue.qsize(),
+            "dropped_lines": self.dropped_lines,
+            "write_errors": self.write_errors
+        }
@@ -0,0 +1,198 @@
+import asyncio
+import threading
+from collections import deque
+from typing import List, Optional
+
+DROP_OLDEST = "drop-oldest"
+CLOSE = "close"
+
+
+class LogSubscription:
+    """
+    A reader of LogBroadcaster. Behaves like the deque get_logs() used to
+    return (len(), popleft()) and can be consumed with `async for`.
+    A subscriber that lags more than maxlen lines behind either skips the
+    oldest lines (drop-oldest) or gets closed (close).
+    """
+
+    def __init__(self, broadcaster: "LogBroadcaster", cursor: int, maxlen: int, overflow: str):
+        self._broadcaster = broadcaster
+        self._cursor = cursor
+        self._pending = deque()
+        self._event = threading.Event()
+        self._loop = None
+        self._async_event = None
+        self.maxlen = maxlen
+        self.overflow = overflow
+        self.received = 0
+        self.dropped = 0
+        self.closed = False
+
+    @property
+    def lag(self) -> int:
+        if self.closed:
+            return len(self._pending)
+        return len(self._pending) + self._broadcaster.sequence - self._cursor
+
+    def _fetch(self, limit: int = None) -> List[str]:
+        if self.closed:
+            return []
+        self._cursor, lines = self._broadcaster._read(self, self._cursor, limit)
+        return lines
+
+    def read(self, limit: int = None) -> List[str]:
+        lines = list(self._pending)
+        self._pending.clear()
+        lines.extend(self._fetch(None if limit is None else max(limit - len(lines), 0)))
+        self.received += len(lines)
+        return lines
+
+    def wait(self, timeout: float = None) -> bool:
+        self._event.clear()
+        if self._pending or self.lag or self.closed:
+            return True
+        return self._event.wait(timeout)
+
+    def close(self):
+        self._broadcaster.unsubscribe(self)
+
+    def _notify(self):
+        self._event.set()
+        if self._loop is not None:
+            try:
+                self._loop.call_soon_threadsafe(self._async_event.set)
+            except RuntimeError:  # loop is closed
+                self._loop = None
+
+    def __len__(self):
+        return min(self.lag, len(self._pending) + self.maxlen)
+
+    def __bool__(self):
+        return self.lag > 0
+
+    def popleft(self) -> str:
+        if not self._pending:
+            self._pending.extend(self._fetch())
+        if not self._pending:
+            raise IndexError("pop from an empty log subscription")
+        self.received += 1
+        return self._pending.popleft()
+
+    def __iter__(self):
+        while self:
+            yield self.popleft()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> str:
+        if self._loop is None:
+            self._async_event = asyncio.Event()
+            self._loop = asyncio.get_running_loop()
+
+        while not self._pending:
+            self._async_event.clear()
+            self._pending.extend(self._fetch())
+            if self._pending:
+                break
+            if self.closed:
+                raise StopAsyncIteration
+            await self._async_event.wait()
+
+        self.received += 1
+        return self._pending.popleft()
+
+    def stats(self) -> dict:
+        return {
+            "received": self.received,
+            "dropped": self.dropped,
+            "lag": self.lag,
+            "closed": self.closed
+        }
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class LogBroadcaster:
+    """
+    Fans captured log lines out to many subscribers. Lines are stored once in
+    a ring shared by all subscribers, each of them only keeps a cursor, so
+    publishing costs the same no matter how many readers there are.
+    """
+
+    def __init__(self, capacity: int = 10000):
+        self._lock = threading.Lock()
+        self._ring: List[Optional[str]] = [None] * capacity
+        self._subscribers = set()
+        self.capacity = capacity
+        self.sequence = 0  # sequence number of the next published line
+        self.dropped = 0
+
+    def publish(self, lines: List[str]):
+        with self._lock:
+            if len(lines) > self.capacity:
+                self.sequence += len(lines) - self.capacity
+                lines = lines[-self.capacity:]
+            start = self.sequence % self.capacity
+            head = lines[:self.capacity - start]
+            self._ring[start:start + len(head)] = head
+            self._ring[:len(lines) - len(head)] = lines[len(head):]
+            self.sequence += len(lines)
+            subscribers = tuple(self._subscribers)
+
+        for subscriber in subscribers:
+            subscriber._notify()
+
+    def subscribe(self, maxlen: int = 100, history: int = 0, overflow: str = DROP_OLDEST) -> LogSubscription:
+        if overflow not in (DROP_OLDEST, CLOSE):
+            raise ValueError(f"unknown overflow policy {overflow}")
+        maxlen = min(maxlen, self.capacity)
+
+        with self._lock:
+            history = min(history, maxlen, self.sequence, self.capacity)
+            subscription = LogSubscription(self, self.sequence - history, maxlen, overflow)
+            self._subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: LogSubscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+            subscription.closed = True
+        subscription._notify()
+
+    def _read(self, subscription: LogSubscription, cursor: int, limit: int = None):
+        with self._lock:
+            lag = self.sequence - cursor
+            if lag > subscription.maxlen:
+                skipped = lag - subscription.maxlen
+                subscription.dropped += skipped
+                self.dropped += skipped
+                if subscription.overflow == CLOSE:
+                    self._subscribers.discard(subscription)
+                    subscription.closed = True
+                    return self.sequence, []
+                cursor += skipped
+
+            end = self.sequence if limit is None else min(self.sequence, cursor + limit)
+            start, stop = cursor % self.capacity, end % self.capacity
+            if end - cursor == 0:
+                lines = []
+            elif start < stop:
+                lines = self._ring[start:stop]
+            else:
+                lines = self._ring[start:] + self._ring[:stop]
+            return end, lines
+
+    def stats(self) -> dict:
+        with self._lock:
+            subscribers = tuple(self._subscribers)
+            published, dropped = self.sequence, self.dropped
+        return {
+            "published": published,
+            "dropped": dropped,
+            "subscribers": [subscriber.stats() for subscriber in subscribers]
+        }
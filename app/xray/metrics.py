@@ -0,0 +1,179 @@
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+from app import logger
+
+# host:port of the Prometheus endpoint, empty to disable it
+XRAY_METRICS_LISTEN = os.environ.get("XRAY_METRICS_LISTEN", "")
+XRAY_METRICS_INTERVAL = float(os.environ.get("XRAY_METRICS_INTERVAL", 15))
+
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+
+def read_process_stats(pid: int) -> Optional[dict]:
+    """Resource usage of a process from /proc, None if it doesn't exist anymore."""
+    try:
+        with open(f"/proc/{pid}/stat") as file:
+            # the command name may contain spaces, fields are counted after it
+            fields = file.read().rsplit(')', 1)[1].split()
+        with open(f"/proc/{pid}/status") as file:
+            status = dict(line.split(':', 1) for line in file if ':' in line)
+        fds = len(os.listdir(f"/proc/{pid}/fd"))
+        max_fds = None
+        with open(f"/proc/{pid}/limits") as file:
+            for line in file:
+                if line.startswith("Max open files"):
+                    value = line.split()[3]
+                    max_fds = int(value) if value.isdigit() else None
+    except (OSError, IndexError, ValueError):
+        return None
+
+    return {
+        "cpu_user_seconds": int(fields[11]) / CLOCK_TICKS,
+        "cpu_system_seconds": int(fields[12]) / CLOCK_TICKS,
+        "threads": int(fields[17]),
+        "rss_bytes": int(fields[21]) * PAGE_SIZE,
+        "virtual_memory_bytes": int(fields[20]),
+        "open_fds": fds,
+        "max_fds": max_fds,
+        "voluntary_ctxt_switches": int(status.get("voluntary_ctxt_switches", 0)),
+        "nonvoluntary_ctxt_switches": int(status.get("nonvoluntary_ctxt_switches", 0))
+    }
+
+
+PROCESS_METRICS = (
+    # (name, type, help, key of read_process_stats)
+    ("xray_process_cpu_user_seconds_total", "counter", "User CPU time of the Xray process", "cpu_user_seconds"),
+    ("xray_process_cpu_system_seconds_total", "counter", "System CPU time of the Xray process", "cpu_system_seconds"),
+    ("xray_process_resident_memory_bytes", "gauge", "Resident memory of the Xray process", "rss_bytes"),
+    ("xray_process_virtual_memory_bytes", "gauge", "Virtual memory of the Xray process", "virtual_memory_bytes"),
+    ("xray_process_threads", "gauge", "Threads of the Xray process", "threads"),
+    ("xray_process_open_fds", "gauge", "Open file descriptors of the Xray process", "open_fds"),
+    ("xray_process_max_fds", "gauge", "Open file descriptors limit of the Xray process", "max_fds"),
+    ("xray_process_voluntary_ctxt_switches_total", "counter", "Voluntary context switches of the Xray process",
+     "voluntary_ctxt_switches"),
+    ("xray_process_nonvoluntary_ctxt_switches_total", "counter", "Involuntary context switches of the Xray process",
+     "nonvoluntary_ctxt_switches"),
+)
+
+CORE_METRICS = (
+    # (name, type, help, getter of XRayCore)
+    ("xray_up", "gauge", "Whether the Xray process is running", lambda core: int(core.started)),
+    ("xray_uptime_seconds", "gauge", "Seconds since the Xray process was started", lambda core: core.uptime),
+    ("xray_time_to_ready_seconds", "gauge", "Seconds the last started Xray took to get ready",
+     lambda core: core.time_to_ready),
+    ("xray_config_size_bytes", "gauge", "Size of the running Xray config", lambda core: core.config_size),
+    ("xray_restarts_total", "counter", "Xray restarts", lambda core: core.lifecycle_stats["restarts"]),
+    ("xray_last_restart_duration_seconds", "gauge", "Duration of the last Xray restart",
+     lambda core: core.lifecycle_stats["last_restart_duration"]),
+    ("xray_skipped_restarts_total", "counter", "Restarts skipped since the config didn't change",
+     lambda core: core.skipped_restarts),
+    ("xray_hot_reloads_total", "counter", "Config changes applied through the Xray API",
+     lambda core: core.reload_stats["hot_applied"]),
+    ("xray_crashes_total", "counter", "Unexpected exits of Xray", lambda core: core.lifecycle_stats["crashes"]),
+    ("xray_supervisor_restarts_total", "counter", "Restarts of crashed Xray processes",
+     lambda core: core.lifecycle_stats["supervisor_restarts"]),
+    ("xray_killed_total", "counter", "Xray processes killed after not stopping in time",
+     lambda core: core.lifecycle_stats["killed"]),
+    ("xray_log_lines_total", "counter", "Captured Xray output lines", lambda core: core.log_stats["lines"]),
+    ("xray_log_bytes_total", "counter", "Captured Xray output bytes", lambda core: core.log_stats["bytes"]),
+    ("xray_online_users", "gauge", "Users Xray reports online",
+     lambda core: core.presence.stats()["online"] if core.presence.running else None),
+)
+
+
+class MetricsSampler:
+    """
+    Samples /proc of the Xray process of a XRayCore in background. Scrapes
+    render the last sample, so they don't touch /proc themselves.
+    """
+
+    def __init__(self, core, interval: float = XRAY_METRICS_INTERVAL):
+        self.core = core
+        self.interval = interval
+        self._sample = None
+        self._sampled_at = None
+        self._thread = None
+        self._server = None
+
+    def sample(self):
+        pid = self.core.pid
+        self._sample = read_process_stats(pid) if pid is not None else None
+        self._sampled_at = time.time()
+
+    def _run(self):
+        while True:
+            try:
+                self.sample()
+            except Exception as e:
+                logger.error(f"Unable to sample Xray process stats: {e}")
+            time.sleep(self.interval)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True, name="xray-metrics")
+            self._thread.start()
+
+    def render(self) -> str:
+        lines = []
+
+        def add(name, metric_type, help_text, value):
+            if value is None:
+                return
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            lines.append(f"{name} {value}")
+
+        sample = self._sample
+        if sample:
+            for name, metric_type, help_text, key in PROCESS_METRICS:
+                add(name, metric_type, help_text, sample[key])
+
+        for name, metric_type, help_text, getter in CORE_METRICS:
+            add(name, metric_type, help_text, getter(self.core))
+
+        if self._sampled_at is not None:
+            lines.append("# HELP xray_metrics_sampled_at_seconds Unix time of the last /proc sample")
+            lines.append("# TYPE xray_metrics_sampled_at_seconds gauge")
+            lines.append(f"xray_metrics_sampled_at_seconds {self._sampled_at}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, listen: str = XRAY_METRICS_LISTEN):
+        host, _, port = listen.rpartition(':')
+        sampler = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?', 1)[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = sampler.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host or "127.0.0.1", int(port)), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True, name="xray-metrics-http").start()
+        logger.info(f"Xray metrics are served on http://{listen}/metrics")
+
+
+def start_exporter(core, listen: str = XRAY_METRICS_LISTEN) -> Optional[MetricsSampler]:
+    if not listen:
+        return None
+    sampler = MetricsSampler(core)
+    sampler.start()
+    try:
+        sampler.serve(listen)
+    except OSError as e:
+        logger.error(f"Unable to serve Xray metrics on {listen}: {e}")
+    return sampler
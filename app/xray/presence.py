@@ -0,0 +1,294 @@
+import os
+import threading
+import time
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from app import logger
+
+XRAY_PRESENCE_TRACKER = os.environ.get("XRAY_PRESENCE_TRACKER", "false").lower() == "true"
+XRAY_PRESENCE_INTERVAL = float(os.environ.get("XRAY_PRESENCE_INTERVAL", 15))
+XRAY_PRESENCE_FLUSH_INTERVAL = float(os.environ.get("XRAY_PRESENCE_FLUSH_INTERVAL", 60))
+QUERY_TIMEOUT = 30
+
+STATS_SERVICE = "/xray.app.stats.command.StatsService"
+
+
+# the stats service messages used here are tiny, they are encoded by hand
+# instead of depending on generated protobuf modules of a specific xray version
+
+def _encode_varint(value: int) -> bytes:
+    data = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            data.append(byte | 0x80)
+        else:
+            data.append(byte)
+            return bytes(data)
+
+
+def _read_varint(data: bytes, pos: int) -> tuple:
+    result = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+
+def _iter_fields(data: bytes):
+    """Yields (field number, value) of a protobuf message, values are ints or bytes."""
+    pos = 0
+    while pos < len(data):
+        key, pos = _read_varint(data, pos)
+        number, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            value, pos = _read_varint(data, pos)
+        elif wire_type == 2:
+            size, pos = _read_varint(data, pos)
+            value, pos = data[pos:pos + size], pos + size
+        elif wire_type == 1:
+            value, pos = int.from_bytes(data[pos:pos + 8], 'little'), pos + 8
+        elif wire_type == 5:
+            value, pos = int.from_bytes(data[pos:pos + 4], 'little'), pos + 4
+        else:
+            raise ValueError(f"unsupported protobuf wire type {wire_type}")
+        yield number, value
+
+
+def encode_stats_request(name: str) -> bytes:
+    # GetStatsRequest{name = 1}
+    name = name.encode()
+    return b'\x0a' + _encode_varint(len(name)) + name
+
+
+def decode_online_users(data: bytes) -> List[str]:
+    # GetAllOnlineUsersResponse{repeated string users = 1}
+    return [value.decode() for number, value in _iter_fields(data) if number == 1]
+
+
+def decode_online_ips(data: bytes) -> Dict[str, int]:
+    # GetStatsOnlineIpListResponse{name = 1, map<string, int64> ips = 2}
+    ips = {}
+    for number, value in _iter_fields(data):
+        if number != 2:
+            continue
+        ip, last_seen = None, 0
+        for entry_number, entry_value in _iter_fields(value):
+            if entry_number == 1:
+                ip = entry_value.decode()
+            elif entry_number == 2:
+                last_seen = entry_value
+        if ip is not None:
+            ips[ip] = last_seen
+    return ips
+
+
+class UserPresence:
+    __slots__ = ('email', 'last_seen', 'ips')
+
+    def __init__(self, email: str):
+        self.email = email
+        self.last_seen = None  # unix time
+        self.ips = {}  # ip -> unix time it was last seen
+
+    def as_dict(self) -> dict:
+        return {
+            "email": self.email,
+            "last_seen": self.last_seen,
+            "ips": dict(self.ips)
+        }
+
+
+class PresenceTracker:
+    """
+    Keeps an in-memory table of online users of a XRayCore, built from the
+    online stats of Xray (statsUserOnline policy). Each poll lists the online
+    users with GetAllOnlineUsers and fetches all their IP lists concurrently
+    over the same channel. Users' online_at is written to the database with
+    one bulk update per flush interval.
+    """
+
+    def __init__(self, core, interval: float = XRAY_PRESENCE_INTERVAL,
+                 flush_interval: float = XRAY_PRESENCE_FLUSH_INTERVAL):
+        self.core = core
+        self.interval = interval
+        self.flush_interval = flush_interval
+
+        self._lock = threading.Lock()
+        self._thread = None
+        self._channel = None
+        self._channel_address = None
+        self._users: Dict[int, UserPresence] = {}
+        self._changed = set()
+        self._last_flush = time.monotonic()
+
+        self.polls = 0
+        self.poll_errors = 0
+        self.flushes = 0
+        self.flush_errors = 0
+        self.last_poll_latency = None
+        self.last_poll_at = None
+        self.last_flush_duration = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self._thread = threading.Thread(target=self._run, daemon=True, name="xray-presence")
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            if self.core.started:
+                self.poll()
+            if time.monotonic() - self._last_flush >= self.flush_interval:
+                self.flush()
+
+    def _get_channel(self):
+        import grpc
+
+        address = "%s:%d" % self.core.config.api_address
+        if self._channel is None or self._channel_address != address:
+            if self._channel is not None:
+                self._channel.close()
+            self._channel = grpc.insecure_channel(address)
+            self._channel_address = address
+        return self._channel
+
+    def query(self) -> Dict[str, Dict[str, int]]:
+        """Returns {email: {ip: last seen}} of users Xray reports online."""
+        channel = self._get_channel()
+        get_online_users = channel.unary_unary(f"{STATS_SERVICE}/GetAllOnlineUsers")
+        get_ip_list = channel.unary_unary(f"{STATS_SERVICE}/GetStatsOnlineIpList")
+
+        names = decode_online_users(get_online_users(b'', timeout=QUERY_TIMEOUT))
+        futures = [(name, get_ip_list.future(encode_stats_request(name), timeout=QUERY_TIMEOUT))
+                   for name in names]
+
+        online = {}
+        for name, future in futures:
+            # names are "user>>>{email}>>>online"
+            parts = name.split('>>>')
+            email = parts[1] if len(parts) == 3 else name
+            try:
+                online[email] = decode_online_ips(future.result())
+            except Exception as e:
+                # the user may have disconnected in the meantime
+                logger.debug(f"Unable to get online IPs of {email}: {e}")
+        return online
+
+    def poll(self) -> bool:
+        started_at = time.monotonic()
+        try:
+            online = self.query()
+        except Exception as e:
+            self.poll_errors += 1
+            logger.error(f"Unable to query Xray online users: {e}")
+            return False
+
+        now = time.time()
+        with self._lock:
+            seen = set()
+            for email, ips in online.items():
+                # emails are "<user id>.<username>"
+                try:
+                    uid = int(email.split('.', 1)[0])
+                except ValueError:
+                    continue
+                presence = self._users.get(uid)
+                if presence is None:
+                    presence = self._users[uid] = UserPresence(email)
+                presence.last_seen = now
+                presence.ips = ips
+                seen.add(uid)
+            for uid, presence in self._users.items():
+                if uid not in seen:
+                    presence.ips = {}
+            self._changed |= seen
+
+        self.polls += 1
+        self.last_poll_at = now
+        self.last_poll_latency = time.monotonic() - started_at
+        return True
+
+    def flush(self) -> bool:
+        from sqlalchemy import bindparam, update
+
+        from app.db import GetDB
+        from app.db import models as db_models
+
+        with self._lock:
+            changed, self._changed = self._changed, set()
+            params = [
+                {"uid": uid, "online_at": datetime.utcfromtimestamp(self._users[uid].last_seen)}
+                for uid in changed
+            ]
+        self._last_flush = time.monotonic()
+
+        if not params:
+            return True
+
+        started_at = time.monotonic()
+        try:
+            with GetDB() as db:
+                table = db_models.User.__table__
+                stmt = update(table).where(table.c.id == bindparam('uid')) \
+                    .values(online_at=bindparam('online_at'))
+                db.execute(stmt, params)
+                db.commit()
+        except Exception as e:
+            with self._lock:
+                self._changed |= changed
+            self.flush_errors += 1
+            logger.error(f"Unable to record users' online_at: {e}")
+            return False
+
+        self.flushes += 1
+        self.last_flush_duration = time.monotonic() - started_at
+        return True
+
+    def get(self, user_id: int) -> Optional[dict]:
+        with self._lock:
+            presence = self._users.get(user_id)
+            return presence.as_dict() if presence else None
+
+    def is_online(self, user_id: int) -> bool:
+        with self._lock:
+            presence = self._users.get(user_id)
+            return bool(presence and presence.ips)
+
+    def ip_count(self, user_id: int) -> int:
+        with self._lock:
+            presence = self._users.get(user_id)
+            return len(presence.ips) if presence else 0
+
+    def online_users(self) -> Dict[int, dict]:
+        with self._lock:
+            return {uid: p.as_dict() for uid, p in self._users.items() if p.ips}
+
+    def stats(self) -> dict:
+        with self._lock:
+            online = sum(1 for p in self._users.values() if p.ips)
+            tracked, pending = len(self._users), len(self._changed)
+        return {
+            "running": self.running,
+            "online": online,
+            "tracked": tracked,
+            "pending": pending,
+            "polls": self.polls,
+            "poll_errors": self.poll_errors,
+            "last_poll_latency": self.last_poll_latency,
+            "last_poll_at": self.last_poll_at,
+            "flushes": self.flushes,
+            "flush_errors": self.flush_errors,
+            "last_flush_duration": self.last_flush_duration
+        }
@@ -0,0 +1,118 @@
+import threading
+import time
+from concurrent.futures import Future
+
+from app import logger
+
+
+class RestartScheduler:
+    """
+    Coalesces restart requests of a XRayCore. Requests submitted within the
+    debounce window are merged and only the latest submitted config gets
+    applied, once. max_delay bounds how long a burst of requests can
+    postpone the restart. A merged burst only hot-applies or skips an
+    unchanged config if every request of it allowed that.
+    """
+
+    def __init__(self, core, debounce: float = 0.5, max_delay: float = 5):
+        self.core = core
+        self.debounce = debounce
+        self.max_delay = max_delay
+
+        self._cond = threading.Condition()
+        self._pending = None  # (config, api, skip_unchanged)
+        self._futures = []
+        self._first_request_at = None
+        self._last_request_at = None
+        self._worker = None
+
+        self.requested = 0
+        self.coalesced = 0
+        self.applied = 0
+        self.failed = 0
+        self.last_latency = None
+        self.last_duration = None
+
+    @property
+    def queue_length(self) -> int:
+        with self._cond:
+            return len(self._futures)
+
+    def submit(self, config, api=None, skip_unchanged: bool = False) -> Future:
+        future = Future()
+        # hot-applying skips unchanged configs too
+        skip_unchanged = skip_unchanged or api is not None
+        with self._cond:
+            now = time.monotonic()
+            if self._pending is not None:
+                self.coalesced += 1
+                _, pending_api, pending_skip_unchanged = self._pending
+                if pending_api is None:
+                    api = None
+                skip_unchanged = skip_unchanged and pending_skip_unchanged
+            else:
+                self._first_request_at = now
+            self._pending = (config, api, skip_unchanged)
+            self._last_request_at = now
+            self._futures.append(future)
+            self.requested += 1
+
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, daemon=True)
+                self._worker.start()
+            self._cond.notify()
+        return future
+
+    def _wait_for_window(self):
+        # called with the condition acquired
+        while True:
+            now = time.monotonic()
+            deadline = min(self._last_request_at + self.debounce, self._first_request_at + self.max_delay)
+            if now >= deadline:
+                return
+            self._cond.wait(deadline - now)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if self._pending is None:
+                    self._worker = None
+                    return
+                self._wait_for_window()
+                (config, api, skip_unchanged), self._pending = self._pending, None
+                futures, self._futures = self._futures, []
+                first_request_at = self._first_request_at
+
+            started_at = time.monotonic()
+            try:
+                if api is not None:
+                    self.core.reload(config, api=api)
+                elif skip_unchanged:
+                    self.core.restart_if_changed(config)
+                else:
+                    self.core.restart(config)
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"Scheduled Xray restart failed: {e}")
+                for future in futures:
+                    future.set_exception(e)
+                continue
+
+            finished_at = time.monotonic()
+            self.applied += 1
+            self.last_duration = finished_at - started_at
+            self.last_latency = finished_at - first_request_at
+            for future in futures:
+                future.set_result(config)
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "queue_length": len(self._futures),
+                "requested": self.requested,
+                "coalesced": self.coalesced,
+                "applied": self.applied,
+                "failed": self.failed,
+                "last_latency": self.last_latency,
+                "last_duration": self.last_duration
+            }
@@ -0,0 +1,115 @@
+import hashlib
+import json
+from typing import IO, Iterator, Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# containers deeper than this (config > inbounds > inbound > settings > clients)
+# are encoded in one call instead of being walked
+STREAM_DEPTH = 5
+LIST_BATCH_SIZE = 1000
+WRITE_CHUNK_SIZE = 64 * 1024
+
+
+class JSONFragment:
+    """Already encoded JSON which is written to the output as is."""
+    __slots__ = ('data',)
+
+    def __init__(self, data: Union[bytes, str]):
+        self.data = data.encode() if isinstance(data, str) else data
+
+    @classmethod
+    def encode(cls, value) -> "JSONFragment":
+        return cls(_dumps(value))
+
+
+def _default(value):
+    if isinstance(value, JSONFragment):
+        if hasattr(orjson, 'Fragment'):
+            return orjson.Fragment(value.data)
+        return json.loads(value.data)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+if orjson is not None:
+    def _dumps(value, sort_keys: bool = False) -> bytes:
+        return orjson.dumps(value, default=_default, option=orjson.OPT_SORT_KEYS if sort_keys else None)
+else:
+    _encoder = json.JSONEncoder(separators=(',', ':'), ensure_ascii=False, default=_default)
+    _sorted_encoder = json.JSONEncoder(separators=(',', ':'), ensure_ascii=False, default=_default, sort_keys=True)
+
+    def _dumps(value, sort_keys: bool = False) -> bytes:
+        return (_sorted_encoder if sort_keys else _encoder).encode(value).encode()
+
+
+def _iter_encode(value, depth: int = 0, sort_keys: bool = False) -> Iterator[bytes]:
+    if isinstance(value, JSONFragment):
+        yield value.data
+
+    elif depth >= STREAM_DEPTH or not value or not isinstance(value, (dict, list)):
+        yield _dumps(value, sort_keys)
+
+    elif isinstance(value, dict):
+        separator = b'{'
+        items = sorted(value.items(), key=lambda item: str(item[0])) if sort_keys else value.items()
+        for key, item in items:
+            yield separator + _dumps(str(key)) + b':'
+            yield from _iter_encode(item, depth + 1, sort_keys)
+            separator = b','
+        yield b'}'
+
+    else:
+        separator = b'['
+        for i in range(0, len(value), LIST_BATCH_SIZE):
+            batch = value[i:i + LIST_BATCH_SIZE]
+            if depth + 1 >= STREAM_DEPTH and not any(isinstance(item, JSONFragment) for item in batch):
+                # encode plain items (e.g. clients) batch by batch, dropping the brackets
+                yield separator + _dumps(batch, sort_keys)[1:-1]
+                separator = b','
+                continue
+            for item in batch:
+                yield separator
+                yield from _iter_encode(item, depth + 1, sort_keys)
+                separator = b','
+        yield b']'
+
+
+def iter_encode(value, sort_keys: bool = False) -> Iterator[bytes]:
+    """Yields compact JSON of value in chunks of about WRITE_CHUNK_SIZE bytes."""
+    buffer = bytearray()
+    for chunk in _iter_encode(value, sort_keys=sort_keys):
+        buffer += chunk
+        if len(buffer) >= WRITE_CHUNK_SIZE:
+            yield bytes(buffer)
+            buffer.clear()
+    if buffer:
+        yield bytes(buffer)
+
+
+def dump(value, stream: IO[bytes], sort_keys: bool = False, digest=None) -> int:
+    """
+    Writes compact JSON of value to a binary stream, returns written bytes count.
+    The written data is also fed to digest (a hashlib object) if given.
+    """
+    size = 0
+    for chunk in iter_encode(value, sort_keys):
+        stream.write(chunk)
+        if digest is not None:
+            digest.update(chunk)
+        size += len(chunk)
+    return size
+
+
+def fingerprint(value) -> str:
+    """SHA-256 of the canonical (sorted keys, compact) JSON of value."""
+    digest = hashlib.sha256()
+    for chunk in iter_encode(value, sort_keys=True):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def dumps(value) -> str:
+    return b''.join(_iter_encode(value)).decode()
@@ -0,0 +1,57 @@
+"""
+Benchmarks parsing of Xray access log lines by AccessLogIndex.
+
+Runs inside the Marzban container, e.g.:
+
+    docker compose run --rm -v ./benchmarks:/code/benchmarks marzban \
+        python -m benchmarks.access_log --lines 500000 --users 50000
+"""
+import argparse
+import random
+import time
+
+
+def access_lines(count: int, users: int, other_ratio: float, seed: int) -> list:
+    rnd = random.Random(seed)
+    started_at = time.time()
+    lines = []
+    for i in range(count):
+        ts = time.strftime("%Y/%m/%d %H:%M:%S", time.localtime(started_at + i / 1000))
+        if rnd.random() < other_ratio:
+            lines.append(f"{ts}.{i % 1000000:06d} [Info] [{rnd.getrandbits(32)}] app/dispatcher: "
+                         f"taking detour [DIRECT] for [tcp:host{i}.example.com:443]")
+            continue
+        uid = rnd.randrange(1, users + 1)
+        lines.append(f"{ts}.{i % 1000000:06d} from tcp:10.{rnd.randrange(256)}.{rnd.randrange(256)}."
+                     f"{rnd.randrange(256)}:{rnd.randrange(1024, 65536)} accepted "
+                     f"tcp:host{rnd.randrange(10000)}.example.com:443 [VLESS_TCP_REALITY >> DIRECT] "
+                     f"email: {uid}.user{uid}")
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--lines", type=int, default=500000)
+    parser.add_argument("--users", type=int, default=50000)
+    parser.add_argument("--other-ratio", type=float, default=0.1, help="share of non-access lines")
+    parser.add_argument("--batch", type=int, default=1000, help="lines per captured batch")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    from app.xray.access_log import AccessLogIndex
+
+    lines = access_lines(args.lines, args.users, args.other_ratio, args.seed)
+    index = AccessLogIndex()
+
+    start = time.perf_counter()
+    for i in range(0, len(lines), args.batch):
+        index.feed(lines[i:i + args.batch])
+    elapsed = time.perf_counter() - start
+
+    stats = index.stats()
+    print(f"lines={stats['lines']} records={stats['records']} users={stats['users']} "
+          f"time={elapsed:.2f}s throughput={stats['lines'] / elapsed:.0f} lines/s")
+
+
+if __name__ == "__main__":
+    main()
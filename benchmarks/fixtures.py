@@ -0,0 +1,123 @@
+import datetime
+import uuid
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+
+from app.xray.core import x25519_keypair
+
+# (protocol, network, security) of the inbounds the fixture config cycles through
+INBOUND_KINDS = [
+    ("vless", "tcp", "reality"),
+    ("vless", "tcp", "tls"),
+    ("vmess", "ws", "tls"),
+    ("trojan", "grpc", "tls"),
+    ("vless", "xhttp", "reality"),
+    ("shadowsocks", "tcp", "none"),
+]
+
+
+def self_signed_certificate(domain: str = "bench.example.com") -> dict:
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, domain)])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = x509.CertificateBuilder() \
+        .subject_name(name) \
+        .issuer_name(name) \
+        .public_key(key.public_key()) \
+        .serial_number(x509.random_serial_number()) \
+        .not_valid_before(now) \
+        .not_valid_after(now + datetime.timedelta(days=365)) \
+        .add_extension(x509.SubjectAlternativeName([x509.DNSName(domain)]), critical=False) \
+        .sign(key, hashes.SHA256())
+
+    return {
+        "certificate": cert.public_bytes(serialization.Encoding.PEM).decode().splitlines(),
+        "key": key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption()
+        ).decode().splitlines()
+    }
+
+
+def _stream_settings(network: str, security: str, index: int, certificate: dict) -> dict:
+    stream = {"network": network, "security": security}
+
+    if network == "tcp":
+        stream["tcpSettings"] = {"header": {"type": "none"}}
+    elif network == "ws":
+        stream["wsSettings"] = {"path": f"/ws{index}", "host": "bench.example.com"}
+    elif network == "grpc":
+        stream["grpcSettings"] = {"serviceName": f"grpc{index}"}
+    elif network == "xhttp":
+        stream["xhttpSettings"] = {"path": f"/xhttp{index}", "host": "bench.example.com", "mode": "auto"}
+
+    if security == "tls":
+        stream["tlsSettings"] = {
+            "certificates": [{"certificate": certificate["certificate"], "key": certificate["key"]}]
+        }
+    elif security == "reality":
+        stream["realitySettings"] = {
+            "dest": "www.example.com:443",
+            "serverNames": ["www.example.com"],
+            # public key is derived while resolving inbounds
+            "privateKey": x25519_keypair()["private_key"],
+            "shortIds": [uuid.uuid4().hex[:8]]
+        }
+
+    return stream
+
+
+def xray_config(inbounds: int, outbounds: int = 10, rules: int = 20) -> dict:
+    certificate = self_signed_certificate()
+    config = {
+        "log": {"loglevel": "warning"},
+        "inbounds": [],
+        "outbounds": [{"protocol": "freedom", "tag": "DIRECT"}, {"protocol": "blackhole", "tag": "BLOCK"}],
+        "routing": {"rules": []}
+    }
+
+    for i in range(inbounds):
+        protocol, network, security = INBOUND_KINDS[i % len(INBOUND_KINDS)]
+        inbound = {
+            "tag": f"{protocol.upper()} {network.upper()} {security.upper()} {i}",
+            "listen": "0.0.0.0",
+            "port": 10000 + i,
+            "protocol": protocol,
+            "settings": {"clients": []},
+            "streamSettings": _stream_settings(network, security, i, certificate)
+        }
+        if protocol == "vless":
+            inbound["settings"]["decryption"] = "none"
+        elif protocol == "shadowsocks":
+            inbound["settings"]["network"] = "tcp,udp"
+        config["inbounds"].append(inbound)
+
+    for i in range(outbounds):
+        config["outbounds"].append({
+            "protocol": "socks",
+            "tag": f"country-{i}",
+            "settings": {"servers": [{"address": f"10.0.{i // 256}.{i % 256}", "port": 1080}]}
+        })
+
+    for i in range(rules):
+        config["routing"]["rules"].append({
+            "type": "field",
+            "domain": [f"geosite:category-{i}", f"domain:site{i}.example.com"],
+            "outboundTag": f"country-{i % outbounds}" if outbounds else "DIRECT"
+        })
+
+    return config
+
+
+def proxy_settings(proxy_type: str) -> dict:
+    if proxy_type == "vless":
+        return {"id": str(uuid.uuid4()), "flow": "xtls-rprx-vision"}
+    if proxy_type == "vmess":
+        return {"id": str(uuid.uuid4())}
+    if proxy_type == "trojan":
+        return {"password": uuid.uuid4().hex, "flow": ""}
+    return {"password": uuid.uuid4().hex, "method": "chacha20-ietf-poly1305"}
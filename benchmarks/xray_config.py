@@ -0,0 +1,243 @@
+"""
+Benchmarks XRayConfig generation against a synthetic SQLite database.
+
+Runs inside the Marzban container, e.g.:
+
+    docker compose run --rm -v ./benchmarks:/code/benchmarks marzban \
+        python -m benchmarks.xray_config --users 50000 --inbounds 12
+
+Results are stored as JSON, pass a previous result with --compare to see
+the difference per phase.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+PROXY_TYPES = ("vless", "vmess", "trojan", "shadowsocks")
+
+# the database has to be chosen before app modules create their engine
+_db_dir = tempfile.mkdtemp(prefix="marzban-bench-")
+os.environ["SQLALCHEMY_DATABASE_URL"] = f"sqlite:///{_db_dir}/bench.sqlite3"
+
+
+def measure(func, repeat: int = 1, setup=None) -> dict:
+    # setup runs before each run and isn't timed
+    timings = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - start)
+
+    # heap peak is measured in a separate run, tracing slows the code down a lot
+    if setup:
+        setup()
+    tracemalloc.start()
+    result = func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "wall_time": min(timings),
+        "wall_time_avg": sum(timings) / len(timings),
+        "peak_memory": peak,
+        "result": result
+    }
+
+
+def seed_database(users: int, inbound_tags: list, proxy_types: tuple, excluded_ratio: float, seed: int):
+    from sqlalchemy import insert
+
+    from app.db import GetDB
+    from app.db import models as db_models
+    from app.db.base import Base, engine
+    from app.models.proxy import ProxyTypes
+    from app.models.user import UserStatus
+    from benchmarks.fixtures import proxy_settings
+
+    Base.metadata.create_all(engine)
+    rnd = random.Random(seed)
+    statuses = [UserStatus.active] * 8 + [UserStatus.on_hold, UserStatus.expired]
+
+    with GetDB() as db:
+        db.execute(insert(db_models.ProxyInbound.__table__), [{"tag": tag} for tag in inbound_tags])
+        db.execute(insert(db_models.User.__table__), [
+            {"id": i, "username": f"user{i}", "status": rnd.choice(statuses), "used_traffic": 0}
+            for i in range(1, users + 1)
+        ])
+
+        proxies, excluded, proxy_id = [], [], 0
+        for user_id in range(1, users + 1):
+            for proxy_type in proxy_types:
+                proxy_id += 1
+                proxies.append({
+                    "id": proxy_id,
+                    "user_id": user_id,
+                    "type": ProxyTypes(proxy_type),
+                    "settings": proxy_settings(proxy_type)
+                })
+                if rnd.random() < excluded_ratio:
+                    excluded.append({"proxy_id": proxy_id, "inbound_tag": rnd.choice(inbound_tags)})
+
+        db.execute(insert(db_models.Proxy.__table__), proxies)
+        if excluded:
+            db.execute(insert(db_models.excluded_inbounds_association), excluded)
+        db.commit()
+
+    return {"proxies": len(proxies), "excluded_inbounds": len(excluded)}
+
+
+def clear_caches():
+    """Drops the process-wide caches used while constructing a config."""
+    from app.xray import config as xray_config_module
+
+    xray_config_module.cert_SANs_cache.clear()
+    xray_config_module._normalize_config_text.cache_clear()
+    xray_config_module._config_files_cache.clear()
+    # imported on demand by configs with reality inbounds
+    if "app.xray.core" in sys.modules:
+        sys.modules["app.xray.core"]._derive_x25519.cache_clear()
+
+
+def user_changer(users: int, count: int, seed: int):
+    """
+    Renames count random users through an ORM session, so the changes are
+    seen by the user change tracker like the ones made by the API.
+    """
+    from app.db import GetDB
+    from app.db import models as db_models
+
+    rnd = random.Random(seed)
+    generation = 0
+
+    def change():
+        nonlocal generation
+        generation += 1
+        user_ids = rnd.sample(range(1, users + 1), min(count, users))
+        with GetDB() as db:
+            for user in db.query(db_models.User).filter(db_models.User.id.in_(user_ids)):
+                user.username = f"user{user.id}-{generation}"
+            db.commit()
+
+    return change
+
+
+def run(args) -> dict:
+    from app.xray import serializer
+    from app.xray.config import XRayConfig
+    from benchmarks.fixtures import xray_config
+
+    raw_config = xray_config(args.inbounds, args.outbounds, args.rules)
+    inbound_tags = [inbound["tag"] for inbound in raw_config["inbounds"]]
+    seeded = seed_database(args.users, inbound_tags, PROXY_TYPES, args.excluded_ratio, args.seed)
+
+    phases = {}
+    # the first config of a process parses certificates and derives reality keys,
+    # the following ones get them from process-wide caches
+    phases["construct_cold"] = measure(lambda: XRayConfig(raw_config), args.repeat, setup=clear_caches)
+    phases["construct_warm"] = measure(lambda: XRayConfig(raw_config), args.repeat)
+    config = phases["construct_warm"]["result"]
+
+    phases["include_db_users"] = measure(lambda: config.include_db_users(incremental=False), args.repeat)
+    generated = phases["include_db_users"]["result"]
+
+    # the index is built once, then each run only rebuilds the clients of the changed users
+    config.include_db_users(incremental=True)
+    phases["include_db_users_incremental"] = measure(
+        lambda: config.include_db_users(incremental=True), args.repeat,
+        setup=user_changer(args.users, args.changed_users, args.seed))
+
+    phases["to_json"] = measure(lambda: len(generated.to_json()), args.repeat)
+    with open(os.devnull, "wb") as devnull:
+        phases["write_json"] = measure(lambda: generated.write_json(devnull), args.repeat)
+
+    output_size = phases["to_json"]["result"]
+    for phase in phases.values():
+        del phase["result"]
+
+    try:
+        revision = subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(__file__), stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+
+    return {
+        "created_at": datetime.utcnow().isoformat(),
+        "revision": revision,
+        "python": platform.python_version(),
+        "encoder": "orjson" if serializer.orjson else "json",
+        "params": {
+            "users": args.users,
+            "inbounds": args.inbounds,
+            "outbounds": args.outbounds,
+            "rules": args.rules,
+            "excluded_ratio": args.excluded_ratio,
+            "changed_users": args.changed_users,
+            "repeat": args.repeat,
+            **seeded
+        },
+        "clients": sum(len(i.get("settings", {}).get("clients", [])) for i in generated["inbounds"]),
+        "output_size": output_size,
+        "max_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        "phases": phases
+    }
+
+
+def print_report(result: dict, previous: dict = None):
+    print(f"users={result['params']['users']} inbounds={result['params']['inbounds']} "
+          f"clients={result['clients']} output={result['output_size'] / 2 ** 20:.1f} MiB "
+          f"max_rss={result['max_rss'] / 2 ** 20:.0f} MiB encoder={result['encoder']}")
+
+    for name, phase in result["phases"].items():
+        line = f"{name:32} {phase['wall_time'] * 1000:10.1f} ms {phase['peak_memory'] / 2 ** 20:10.1f} MiB"
+        if previous and name in previous.get("phases", {}):
+            before = previous["phases"][name]
+            if before["wall_time"]:
+                line += f"  time {(phase['wall_time'] / before['wall_time'] - 1) * 100:+.0f}%"
+            if before["peak_memory"]:
+                line += f"  memory {(phase['peak_memory'] / before['peak_memory'] - 1) * 100:+.0f}%"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--inbounds", type=int, default=6)
+    parser.add_argument("--outbounds", type=int, default=10)
+    parser.add_argument("--rules", type=int, default=20)
+    parser.add_argument("--excluded-ratio", type=float, default=0.1)
+    parser.add_argument("--changed-users", type=int, default=100,
+                        help="users changed before each incremental build")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="path of the JSON results file")
+    parser.add_argument("--compare", help="previous JSON results file to compare with")
+    args = parser.parse_args()
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as file:
+            previous = json.load(file)
+
+    result = run(args)
+    print_report(result, previous)
+
+    output = args.output or f"bench-xray-config-{args.users}u-{args.inbounds}i-{int(time.time())}.json"
+    with open(output, "w") as file:
+        json.dump(result, file, indent=2)
+    print(f"results saved to {output}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()